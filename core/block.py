@@ -1,11 +1,27 @@
 import time
 import hashlib
-from utils import hash_function
+from core import encoding
+from core import merkle
+from core import mining
+from core import transaction
+
+# The default most bytes of transactions a miner puts into one block
+MAX_BLOCK_BYTES = 100000
+# A block's difficulty is how many leading zero bits its hash needs, so it can't be more than the hash has
+MAX_DIFFICULTY = 256
+
+def work(difficulty: int):
+    """How many hashes a block at this difficulty takes on average, chains are compared by the total of this and not their length"""
+    return 1 << difficulty
 
 # Now I make the class to create objects of "blocks" for the blockchain
 class Block:
-    def __init__(self, tx_list: list, previous_hash, difficulty=1):
-        self.timestamp = time.time()
+    # Slots instead of a __dict__ per block
+    __slots__ = ("timestamp", "data", "previous_hash", "difficulty", "nonce", "merkle_tree", "merkle_tree_layers", "merkle_tree_leaves",
+                 "hash", "mining_time", "mining_attempts")
+
+    def __init__(self, tx_list: list, previous_hash, difficulty=1, engine=None, cancel=None, timestamp=None, nonce=None, keep_merkle_tree=False):
+        self.timestamp = time.time() if timestamp is None else timestamp
         self.data = tx_list # this is either a list of transactions
         self.previous_hash = previous_hash
 
@@ -14,13 +30,25 @@ class Block:
         self.nonce = 0
 
         # This is the block's merkle tree, it returns the root of the tree
-        self.merkle_tree = self.create_merkle_tree()
+        # The layers and leaves are only kept if they are asked for (e.g. to make merkle proofs), otherwise they are None
+        self.merkle_tree_layers = None
+        self.merkle_tree_leaves = None
+        self.merkle_tree = self.create_merkle_tree(keep_merkle_tree)
+
+        # If the nonce is given then the block was already mined (e.g. it came from a peer), so just hash it
+        if nonce is not None:
+            self.nonce = nonce
+            self.hash = self.calculate_hash()
+            self.mining_time = 0
+            self.mining_attempts = 0
+            return
 
         # Creating the block's hash
         self.hash = self.calculate_hash()
 
-        # Function to mine the block
-        self.mine(difficulty)
+        # Function to mine the block (the engine does the nonce search, by default it is the single process one)
+        # If the cancel event is set while mining, this raises mining.MiningInterrupted
+        self.mine(difficulty, engine, cancel)
 
     def data_to_str(self):
         """
@@ -41,15 +69,21 @@ class Block:
         if isinstance(self.data, list): # It should always be a list, but I am leaving this in here cause of Genesis block modification if needed
             data_str = self.merkle_tree
 
-        to_hash = str(self.timestamp) + data_str + self.previous_hash + str(self.nonce) + str(self.difficulty) 
+        return Block.header_hash(self.timestamp, data_str, self.previous_hash, self.nonce, self.difficulty)
+
+    @staticmethod
+    def header_hash(timestamp, merkle_root, previous_hash, nonce, difficulty):
+        """The block hash only needs the header, so a peer can check the proof-of-work before it has the transactions"""
+        to_hash = str(timestamp) + merkle_root + previous_hash + str(nonce) + str(difficulty) 
 
         return hashlib.sha256(to_hash.encode()).hexdigest() # this is returned in a string hexadecimal format - not 0101010111 but instead 2cf24dba5fb0a30e2
     
-    def create_merkle_tree(self):
+    def create_merkle_tree(self, keep_tree=False):
         """
         I will use 'self.data' which is a list of transactions
         
-        Each Transaction has a transaction ID, this is the SHA-256 of the transaction information (self.transaction_id = sha256(self.data)), where self.data is defined from the "data_helper()" function
+        Each Transaction has a transaction ID, this is the SHA-256 of the transaction information, defined from the "data_helper()" function
+        The layers and leaves are only kept on the block when keep_tree is set, and nothing is printed (see print_merkle_tree)
         """
         
         # if no transactions then return error handling
@@ -61,70 +95,164 @@ class Block:
             if len(self.data) < 1: # this used to be set to 8 from worksheet four (this is why this code is here)
                 return "You require at least one transaction in the list!"
             
-            # make the leaves
-            leaves = []
-            for tx in self.data:
-                leaves.append(tx.transaction_id)
-
-            # make the layers
-            layers = [leaves]
-            while len(layers[-1]) > 1:
-                cur = layers[-1]
-                nxt = []
-                for i in range(0, len(cur), 2):
-                    left = cur[i]
-                    right = cur[i + 1] if i + 1 < len(cur) else cur[i] # duplicate last if its an odd one
-                    nxt.append(hash_function.sha256(left + right))
-                layers.append(nxt)
-
-            # assign the root node from the layers matrix
-            root = layers[-1][0]
-
-            # do the print demo for each block
-            print(f"\nCreating merkle tree...")
-            print("\nLeaves (hashes):")
-            for i, h in enumerate(leaves):
-                print(f"    Leaf {i}: {h}")
-
-            print("\nMerkle root:", root)
-
-            print("\nTree (from root to leaves):")
-            for depth, layer in enumerate(reversed(layers), start=0):
-                level = len(layers) - 1 - depth
-                print(f"    Layer {level} ({len(layer)} node(s)):")
-                for node in layer:
-                    print(" ", node)
-
-            # set the root, layers and leaves to the block as an extra
-            self.merkle_tree_root = root
-            self.merkle_tree_layers = layers
-            self.merkle_tree_leaves = leaves
-            
+            # make the leaves, the raw transaction IDs
+            leaves = [tx.txid for tx in self.data]
+
+            # The tree itself is built by core/merkle.py, it only keeps the layers if they are wanted since they are big
+            if keep_tree:
+                layers = merkle.build_layers(leaves)
+                self.merkle_tree_layers = layers
+                self.merkle_tree_leaves = leaves
+                root = layers[-1][0].hex()
+            else:
+                root = merkle.root(leaves).hex()
+
             # return the root of the merkle tree I guess
-            return self.merkle_tree_root
+            return root
         
         # if this is a string (like expected for the genesis block), then just set None as there is no merkle tree
         # this should never be implemented but left just incase of a later change 
         elif isinstance(self.data, str):
             return None
         
-    def mine(self, difficulty):
+    def merkle_proof(self, index: int):
+        """The merkle inclusion proof for the transaction at index"""
+        return self.merkle_proofs([index])[0]
+
+    def merkle_proofs(self, indexes):
+        """
+        The merkle inclusion proofs for the transactions at these indexes, from the kept layers if there are any,
+        otherwise from layers built just for this and thrown away after (blocks in the block store's cache stay small)
+        """
+        layers = self.merkle_tree_layers or merkle.build_layers([tx.txid for tx in self.data])
+        return [merkle.proof(layers, index) for index in indexes]
+
+    def print_merkle_tree(self):
+        """The verbose dump of the block's merkle tree, for when you want to see it (it is built again if it wasn't kept)"""
+        if not self.data:
+            print("No transactions at all")
+            return
+        merkle.print_tree(self.merkle_tree_layers or merkle.build_layers([tx.txid for tx in self.data]))
+
+    def mine(self, difficulty, engine=None, cancel=None):
         """ 
         Method starts with a nonce = 0, keeps incrementing the nonce and hashing the block until hash is good
         Difficulty is the number of how many zeros
+        The actual nonce search is done by the block's mining engine (see core/mining.py)
         """
-        target = 1 << (256 - difficulty)
+        engine = engine or mining.MiningEngine()
         start_time = time.time()
 
-        while True:
-            self.hash = self.calculate_hash() # I realised I have to recalulate the full block hash everytime
-            if int(self.hash, 16) < target: # I use 16 and not "big" here, because I want to use .hexdigest instead of .digest for the SHA-256 function (Dimi used the .digest aka bytes and not hex)
-                end_time = time.time()
-                self.mining_time = end_time - start_time
-                self.mining_attempts = self.nonce + 1 # realised to add one cause we start with a zero
-                return
-            self.nonce += 1
-        
+        # Only the nonce changes between attempts, so the engine gets the bits either side of it
+        prefix = str(self.timestamp) + self.merkle_tree + self.previous_hash
+        suffix = str(difficulty)
+        self.nonce, self.hash, self.mining_attempts = engine.search(prefix, suffix, difficulty, cancel)
+
+        end_time = time.time()
+        self.mining_time = end_time - start_time
+
+    def is_valid_proof(self, min_difficulty: int = 0):
+        """
+        A single hash check, the header must hash to self.hash and that has to be below the target
+        The block's own difficulty can't be below min_difficulty (the network's), or a block could just declare a target it meets for free
+        """
+        return self.hash == self.calculate_hash() and Block.meets_target(self.hash, self.difficulty, min_difficulty)
+
+    @staticmethod
+    def meets_target(block_hash: str, difficulty: int, min_difficulty: int = 0):
+        """True if the hash is below the target for difficulty, and difficulty is at least min_difficulty (and at most MAX_DIFFICULTY)"""
+        return min_difficulty <= difficulty <= MAX_DIFFICULTY and int(block_hash, 16) < 1 << (256 - difficulty)
+
+    def header_bytes(self):
+        """The version byte then the fixed size header (timestamp, previous hash, merkle root, nonce, difficulty)"""
+        return bytes([encoding.VERSION]) + encoding.HEADER.pack(self.timestamp, encoding.hash_bytes(self.previous_hash),
+                                                                encoding.hash_bytes(self.merkle_tree), self.nonce, self.difficulty)
+
+    def to_bytes(self):
+        """
+        The full block in the binary encoding for sending to peers and storing on disk - the header,
+        then a varint count of transactions and each transaction's own encoding (Transaction.write())
+        """
+        out = bytearray(self.header_bytes())
+        encoding.write_varint(out, len(self.data))
+        for tx in self.data:
+            tx.write(out)
+        return bytes(out)
+
+    def compact_bytes(self):
+        """The header and just the (short) transaction IDs as raw bytes, peers should already have the transactions themselves from the TX gossip"""
+        out = bytearray(self.header_bytes())
+        encoding.write_varint(out, len(self.data))
+        for tx in self.data:
+            out += bytes.fromhex(tx.short_id())
+        return bytes(out)
+
+    @staticmethod
+    def read_header(view, offset: int = 0):
+        """Read a header_bytes(), returns ((timestamp, previous hash, merkle root, nonce, difficulty), offset after it)"""
+        offset = encoding.check_version(view, offset)
+        timestamp, previous_hash, merkle_root, nonce, difficulty = encoding.HEADER.unpack_from(view, offset)
+        return (timestamp, previous_hash.hex(), merkle_root.hex(), nonce, difficulty), offset + encoding.HEADER.size
+
+    @classmethod
+    def read(cls, view, offset: int = 0):
+        """
+        Read one mined block from a bytes/memoryview at offset, returns (block, offset after it)
+        Raises ValueError if it has no transactions or they don't match the merkle root
+        """
+        # The version byte says whether the transactions have signatures
+        version, _ = encoding.read_version(view, offset)
+        (timestamp, previous_hash, merkle_root, nonce, difficulty), offset = cls.read_header(view, offset)
+        count, offset = encoding.read_varint(view, offset)
+        # Mined blocks always have transactions, an empty one's header has a placeholder merkle root
+        # that doesn't hash to the block's hash, so a wallet's header chain could never get past it
+        if not count:
+            raise ValueError("the block has no transactions")
+        tx_list = []
+        for _ in range(count):
+            tx, offset = transaction.Transaction.read(view, offset, version)
+            tx_list.append(tx)
+        new_block = cls(tx_list, previous_hash, difficulty, timestamp=timestamp, nonce=nonce)
+        if encoding.hash_bytes(new_block.merkle_tree).hex() != merkle_root:
+            raise ValueError("the transactions do not match the block's merkle root")
+        return new_block, offset
+
+    @classmethod
+    def list_from_bytes(cls, data):
+        """Read blocks that were written one after the other (a batch, or a range straight off disk)"""
+        view = memoryview(data)
+        blocks = []
+        offset = 0
+        try:
+            while offset < len(view):
+                blk, offset = cls.read(view, offset)
+                blocks.append(blk)
+        except encoding.DECODE_ERRORS as e:
+            raise ValueError(f"bad block data: {e}")
+        return blocks
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Read exactly one block from to_bytes()"""
+        blocks = cls.list_from_bytes(data)
+        if len(blocks) != 1:
+            raise ValueError("expected exactly one block")
+        return blocks[0]
+
+    @classmethod
+    def read_compact(cls, data):
+        """Read a compact_bytes(), returns (header, short IDs as hex)"""
+        view = memoryview(data)
+        try:
+            header, offset = cls.read_header(view)
+            count, offset = encoding.read_varint(view, offset)
+        except encoding.DECODE_ERRORS as e:
+            raise ValueError(f"bad compact block: {e}")
+        size = transaction.SHORT_ID_LENGTH // 2
+        if offset + count * size != len(view):
+            raise ValueError("bad compact block: wrong number of short IDs")
+        short_ids = [view[i:i + size].hex() for i in range(offset, offset + count * size, size)]
+        return header, short_ids
 
     def __str__(self):
         return f"This is the block, {self.hash}, with a timestamp of {self.timestamp}."
\ No newline at end of file
@@ -0,0 +1,275 @@
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from core import block
+from core import encoding
+
+# The chain on disk is two files in the miner's data directory
+#   blocks.dat - an append-only segment of blocks, each one's to_bytes() straight after the last
+#   index.dat  - a count, then one fixed size record per height (offset into blocks.dat, length, raw block hash),
+#                memory-mapped so looking up a height is just reading at count_size + height * record_size
+#   hashes.dat - a hash table (open addressing) from block hash to height, also memory-mapped and written as blocks are appended,
+#                so a block can be found by its hash without going through the index
+INDEX_COUNT = struct.Struct(">Q")
+INDEX_RECORD = struct.Struct(">QI32s")
+# The index file grows this many records at a time, so it doesn't have to be re-mapped on every block
+INDEX_CHUNK = 4096
+# The hash table's size (in slots) and how many slots are used, then the slots - the last 8 bytes of a block hash
+# (the first ones are mostly zeros from the proof-of-work) and its height + 1, 0 being an empty slot
+# A slot is only trusted once the index record at that height has the same full hash, so slots left behind by a
+# truncated block are just skipped over (and reused)
+HASH_HEADER = struct.Struct(">QQ")
+HASH_SLOT = struct.Struct(">8sQ")
+# The table starts with this many slots and doubles when it is half full
+HASH_MIN_CAPACITY = 8192
+# How many parsed blocks are kept in memory (the most recently read or added)
+CACHE_SIZE = 256
+
+class BlockStore:
+    """
+    A miner's blockchain on disk, it can be used like the old list of blocks (len, [height], [start:stop], append)
+    Opening it only reads the index, blocks are read from disk (and parsed) when they are asked for
+    Truncating (for a reorg) just cuts the count and the end of the segment file off
+    """
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._lock = threading.RLock()
+
+        # Open for reading and writing, creating the files the first time
+        segment_path = os.path.join(directory, "blocks.dat")
+        index_path = os.path.join(directory, "index.dat")
+        hashes_path = os.path.join(directory, "hashes.dat")
+        for path in (segment_path, index_path, hashes_path):
+            if not os.path.exists(path):
+                open(path, "wb").close()
+        self._segment = open(segment_path, "r+b")
+        self._index_file = open(index_path, "r+b")
+
+        if os.path.getsize(index_path) < INDEX_COUNT.size + INDEX_CHUNK * INDEX_RECORD.size:
+            self._index_file.truncate(INDEX_COUNT.size + INDEX_CHUNK * INDEX_RECORD.size)
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+        self._count = INDEX_COUNT.unpack_from(self._index, 0)[0]
+
+        self._cache = OrderedDict()
+
+        self._recover()
+
+        self._hashes_file = open(hashes_path, "r+b")
+        self._hashes = None
+        if os.path.getsize(hashes_path) < HASH_HEADER.size:
+            # A data directory from before there was a hash table, it is built once from the index
+            self._build_hash_table(HASH_MIN_CAPACITY, self._count)
+        else:
+            self._hashes = mmap.mmap(self._hashes_file.fileno(), 0)
+
+    def _recover(self):
+        """If the miner stopped part way through writing a block, drop the half written block off the end"""
+        segment_size = os.fstat(self._segment.fileno()).st_size
+        while self._count:
+            offset, length, _ = self._record(self._count - 1)
+            if offset + length <= segment_size:
+                break
+            self._count -= 1
+        INDEX_COUNT.pack_into(self._index, 0, self._count)
+        self._segment.truncate(self._end_offset())
+
+    def _record(self, height):
+        return INDEX_RECORD.unpack_from(self._index, INDEX_COUNT.size + height * INDEX_RECORD.size)
+
+    def _end_offset(self):
+        """Where the next block goes in the segment file"""
+        if not self._count:
+            return 0
+        offset, length, _ = self._record(self._count - 1)
+        return offset + length
+
+    def _height(self, height):
+        """Turn a (possibly negative) height into a real one, or raise IndexError like a list does"""
+        if height < 0:
+            height += self._count
+        if not 0 <= height < self._count:
+            raise IndexError("block height out of range")
+        return height
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, key):
+        with self._lock:
+            if isinstance(key, slice):
+                start, stop, _ = key.indices(self._count)
+                return self.blocks(start, stop)
+            return self._read(self._height(key))
+
+    def hash_at(self, height):
+        """The hash of the block at this height, straight from the index without reading the block"""
+        with self._lock:
+            return self._record(self._height(height))[2].hex()
+
+    def tip_hash(self):
+        """The hash of the last block, or the genesis previous hash if there are no blocks"""
+        with self._lock:
+            return self.hash_at(-1) if self._count else "0" * 64
+
+    def height_of(self, block_hash):
+        """The height of the block with this hash, or None, looked up in the on-disk hash table"""
+        raw_hash = bytes.fromhex(block_hash)
+        with self._lock:
+            for key, height in self._probe(raw_hash[-8:]):
+                if key == raw_hash[-8:] and self._live_slot(key, height) and self._record(height)[2] == raw_hash:
+                    return height
+            return None
+
+    def _capacity(self):
+        return HASH_HEADER.unpack_from(self._hashes, 0)[0]
+
+    def _probe(self, key):
+        """The used slots from key's slot onwards, as (key, height) until an empty one"""
+        capacity = self._capacity()
+        i = int.from_bytes(key, "big") % capacity
+        while True:
+            slot_key, height = HASH_SLOT.unpack_from(self._hashes, HASH_HEADER.size + i * HASH_SLOT.size)
+            if not height:
+                return
+            yield slot_key, height - 1
+            i = (i + 1) % capacity
+
+    def _live_slot(self, key, height):
+        """True if the slot still belongs to the block at that height (and not one that has been truncated off)"""
+        return height < self._count and self._record(height)[2][-8:] == key
+
+    def _insert_hash(self, height, raw_hash):
+        """Put a height in the hash table, reusing the first slot left behind by a truncated block on the way"""
+        capacity, used = HASH_HEADER.unpack_from(self._hashes, 0)
+        key = raw_hash[-8:]
+        i = int.from_bytes(key, "big") % capacity
+        while True:
+            offset = HASH_HEADER.size + i * HASH_SLOT.size
+            slot_key, slot_height = HASH_SLOT.unpack_from(self._hashes, offset)
+            if not slot_height:
+                used += 1
+                break
+            if (slot_key, slot_height - 1) == (key, height) or not self._live_slot(slot_key, slot_height - 1):
+                break
+            i = (i + 1) % capacity
+        HASH_SLOT.pack_into(self._hashes, offset, key, height + 1)
+        HASH_HEADER.pack_into(self._hashes, 0, capacity, used)
+        if used * 2 > capacity:
+            self._build_hash_table(capacity * 2, max(self._count, height + 1))
+
+    def _build_hash_table(self, capacity, stop):
+        """(Re)write the hash table with at least this many slots, from the index records for heights up to stop"""
+        while capacity < stop * 4:
+            capacity *= 2
+        if self._hashes is not None:
+            self._hashes.close()
+        self._hashes_file.truncate(0)
+        self._hashes_file.truncate(HASH_HEADER.size + capacity * HASH_SLOT.size)
+        self._hashes = mmap.mmap(self._hashes_file.fileno(), 0)
+        HASH_HEADER.pack_into(self._hashes, 0, capacity, 0)
+        for height in range(stop):
+            self._insert_hash(height, self._record(height)[2])
+
+    def _read(self, height):
+        blk = self._cache.get(height)
+        if blk is not None:
+            self._cache.move_to_end(height)
+            return blk
+        offset, length, _ = self._record(height)
+        self._segment.seek(offset)
+        blk = block.Block.from_bytes(self._segment.read(length))
+        self._remember(height, blk)
+        return blk
+
+    def _remember(self, height, blk):
+        self._cache[height] = blk
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def blocks(self, start, stop):
+        """The blocks from start up to (not including) stop, read from disk in one go"""
+        with self._lock:
+            start, stop = max(start, 0), min(stop, self._count)
+            if start >= stop:
+                return []
+            if all(height in self._cache for height in range(start, stop)):
+                return [self._cache[height] for height in range(start, stop)]
+            return block.Block.list_from_bytes(self.raw_range(start, stop))
+
+    def raw_range(self, start, stop):
+        """The encoded blocks from start up to stop exactly as they are on disk, for sending on"""
+        with self._lock:
+            start, stop = max(start, 0), min(stop, self._count)
+            if start >= stop:
+                return b""
+            offset = self._record(start)[0]
+            end_offset, end_length, _ = self._record(stop - 1)
+            self._segment.seek(offset)
+            return self._segment.read(end_offset + end_length - offset)
+
+    def headers(self, start, stop):
+        """The encoded headers from start up to stop, read off the front of each block on disk without parsing the blocks"""
+        with self._lock:
+            headers = []
+            for height in range(max(start, 0), min(stop, self._count)):
+                self._segment.seek(self._record(height)[0])
+                headers.append(self._segment.read(encoding.HEADER_SIZE))
+            return b"".join(headers)
+
+    def work(self, start, stop):
+        """The total proof-of-work (see block.work) of the blocks from start up to stop, from their difficulties in the headers"""
+        headers = self.headers(start, stop)
+        # Each header is the version byte then encoding.HEADER, difficulty is its last field
+        return sum(block.work(encoding.HEADER.unpack_from(headers, offset + 1)[4]) for offset in range(0, len(headers), encoding.HEADER_SIZE))
+
+    def append(self, blk):
+        """Write a block onto the end of the chain"""
+        with self._lock:
+            data = blk.to_bytes()
+            offset = self._end_offset()
+            self._segment.seek(offset)
+            self._segment.write(data)
+            self._segment.flush()
+
+            # Make room in the index if it is full, then write the record before bumping the count
+            if INDEX_COUNT.size + (self._count + 1) * INDEX_RECORD.size > len(self._index):
+                self._index.close()
+                self._index_file.truncate(INDEX_COUNT.size + (self._count + INDEX_CHUNK) * INDEX_RECORD.size)
+                self._index = mmap.mmap(self._index_file.fileno(), 0)
+            INDEX_RECORD.pack_into(self._index, INDEX_COUNT.size + self._count * INDEX_RECORD.size, offset, len(data), bytes.fromhex(blk.hash))
+            # The hash table slot goes in before the count is bumped too, it is ignored until the block is really there
+            self._insert_hash(self._count, bytes.fromhex(blk.hash))
+            self._count += 1
+            INDEX_COUNT.pack_into(self._index, 0, self._count)
+
+            self._remember(self._count - 1, blk)
+
+    def extend(self, blocks):
+        for blk in blocks:
+            self.append(blk)
+
+    def truncate(self, height):
+        """Drop every block from this height onwards (the replaced end of the chain in a reorg)"""
+        with self._lock:
+            if height >= self._count:
+                return
+            height = max(height, 0)
+            # The hash table's slots for these heights are left, they stop matching and get reused
+            for h in [h for h in self._cache if h >= height]:
+                del self._cache[h]
+            self._count = height
+            INDEX_COUNT.pack_into(self._index, 0, self._count)
+            self._segment.truncate(self._end_offset())
+
+    def close(self):
+        with self._lock:
+            self._index.flush()
+            self._index.close()
+            self._index_file.close()
+            self._hashes.flush()
+            self._hashes.close()
+            self._hashes_file.close()
+            self._segment.close()
@@ -0,0 +1,121 @@
+import struct
+
+# The binary encoding blocks and transactions use on the wire and on disk
+# An encoded block (or list of transactions) starts with this version byte, so the format can change later on
+# Version 2 added each transaction's public key and signature, version 1 data (e.g. a chain already on disk) can still be read
+VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+
+# The block header after the version byte: timestamp, previous hash and merkle root (32 raw bytes each), nonce, difficulty
+HEADER = struct.Struct(">d32s32sQH")
+# An encoded header including its version byte, every encoded block starts with one of these
+HEADER_SIZE = 1 + HEADER.size
+FLOAT = struct.Struct(">d")
+
+# What can go wrong reading cut short or corrupt data, callers turn these into a ValueError
+DECODE_ERRORS = (IndexError, struct.error)
+
+# Numbers (amounts, fees and timestamps) are kept exactly as their text, because the transaction ID hashes the text
+# Each one is a kind byte and then the number in the smallest form that gives back the same text
+NUMBER_INT = 0    # a whole number, as a varint
+NUMBER_UNITS = 1  # a decimal with up to 8 places, as a varint count of 0.00000001s
+NUMBER_FLOAT = 2  # any other float, as 8 bytes
+NUMBER_TEXT = 3   # anything else, the text itself
+UNITS = 10 ** 8
+
+def write_varint(out: bytearray, n: int):
+    """Unsigned LEB128, 7 bits a byte with the top bit set on every byte but the last"""
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(view, offset: int):
+    """Returns (n, offset after it)"""
+    n = 0
+    shift = 0
+    while True:
+        byte = view[offset]
+        offset += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+
+def write_str(out: bytearray, s: str):
+    write_bytes(out, s.encode("utf-8"))
+
+def read_str(view, offset: int):
+    data, offset = read_bytes(view, offset)
+    return str(data, "utf-8"), offset
+
+def write_bytes(out: bytearray, data: bytes):
+    """Length-prefixed raw bytes"""
+    write_varint(out, len(data))
+    out += data
+
+def read_bytes(view, offset: int):
+    length, offset = read_varint(view, offset)
+    end = offset + length
+    if end > len(view):
+        raise ValueError("truncated data")
+    return bytes(view[offset:end]), end
+
+def write_number(out: bytearray, text: str):
+    """Write a number given as its text (e.g. str(amount)), so that read_number gives back exactly the same text"""
+    if text.isascii() and text.isdigit() and str(int(text)) == text:
+        out.append(NUMBER_INT)
+        write_varint(out, int(text))
+        return
+    try:
+        value = float(text)
+    except ValueError:
+        value = None
+    if value is not None and repr(value) == text:
+        # A varint only beats the 8 byte float while it fits in 7 bytes (49 bits)
+        units = round(value * UNITS) if 0 <= value < 1e12 else -1
+        if 0 <= units < 1 << 49 and repr(units / UNITS) == text:
+            out.append(NUMBER_UNITS)
+            write_varint(out, units)
+        else:
+            out.append(NUMBER_FLOAT)
+            out += FLOAT.pack(value)
+        return
+    out.append(NUMBER_TEXT)
+    write_str(out, text)
+
+def read_number(view, offset: int):
+    """Returns (the number's text, offset after it)"""
+    kind = view[offset]
+    offset += 1
+    if kind == NUMBER_INT:
+        n, offset = read_varint(view, offset)
+        return str(n), offset
+    if kind == NUMBER_UNITS:
+        n, offset = read_varint(view, offset)
+        return repr(n / UNITS), offset
+    if kind == NUMBER_FLOAT:
+        return repr(FLOAT.unpack_from(view, offset)[0]), offset + FLOAT.size
+    if kind == NUMBER_TEXT:
+        return read_str(view, offset)
+    raise ValueError(f"unknown number kind {kind}")
+
+def parse_number(text: str):
+    """An int if the text is a whole number, otherwise a float (str() of it gives back the same text)"""
+    return int(text) if text.isascii() and text.isdigit() else float(text)
+
+def hash_bytes(hex_hash: str):
+    """A hex hash as 32 raw bytes (an empty block's placeholder merkle root is all zeros)"""
+    return bytes.fromhex(hex_hash) if len(hex_hash) == 64 else bytes(32)
+
+def read_version(view, offset: int):
+    """Reads the version byte, returns (version, offset after it), raises ValueError if it is not one this code understands"""
+    if offset >= len(view):
+        raise ValueError("truncated data")
+    if view[offset] not in SUPPORTED_VERSIONS:
+        raise ValueError(f"unknown encoding version {view[offset]}")
+    return view[offset], offset + 1
+
+def check_version(view, offset: int):
+    """Reads the version byte, raises ValueError if it is not one this code understands"""
+    return read_version(view, offset)[1]
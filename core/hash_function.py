@@ -4,4 +4,8 @@ import hashlib
 # This will be in 'hexdigest' not 'digest', so I can read it as a human
 def sha256(data):
     """Simple SHA256 function"""
-    return hashlib.sha256(data.encode('UTF-8')).hexdigest()
\ No newline at end of file
+    return hashlib.sha256(data.encode('UTF-8')).hexdigest()
+
+def sha256_digest(data):
+    """The same hash as the raw 32 bytes, which is half the size to keep in memory"""
+    return hashlib.sha256(data.encode('UTF-8')).digest()
\ No newline at end of file
@@ -0,0 +1,72 @@
+from core import block
+from core import encoding
+
+class ChainForked(Exception):
+    """The miner's chain doesn't have our header at this height, so it has forked away from (or is shorter than) ours"""
+    def __init__(self, height):
+        super().__init__(f"the chain has forked at height {height}")
+        self.height = height
+
+class HeaderChain:
+    """
+    A wallet's copy of just the block headers, enough to check that the miner it talks to is serving a real proof-of-work chain
+    Only each block's hash and merkle root (32 raw bytes each) are kept, and every new header is checked as it is added -
+    it has to link to the one before it and its hash has to be below its target, at no less than min_difficulty
+    (the network's, otherwise a miner could make up easy headers with whatever merkle roots it liked)
+    """
+    def __init__(self, min_difficulty: int = 1):
+        self.min_difficulty = min_difficulty
+        self._hashes = []
+        self._merkle_roots = []
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def tip_hash(self):
+        """The hash of the last header, or the genesis previous hash if there are none"""
+        return self._hashes[-1].hex() if self._hashes else "0" * 64
+
+    def block_hash(self, height):
+        return self._hashes[height].hex()
+
+    def merkle_root(self, height):
+        return self._merkle_roots[height].hex()
+
+    def add_headers(self, start, data):
+        """
+        Add a run of encoded headers (a GET_HEADERS reply starting at height start), returns how many new ones were added
+        Headers we already have are only compared, the first one that isn't ours raises ChainForked
+        A new header that doesn't link up or has a bad proof-of-work raises ValueError (the ones before it are kept)
+        """
+        view = memoryview(data)
+        if len(view) % encoding.HEADER_SIZE:
+            raise ValueError("headers are not a whole number of headers long")
+        if start > len(self):
+            raise ValueError(f"headers from {start} would leave a gap after {len(self)}")
+        added = 0
+        for height, offset in enumerate(range(0, len(view), encoding.HEADER_SIZE), start=start):
+            try:
+                (timestamp, previous_hash, merkle_root, nonce, difficulty), _ = block.Block.read_header(view, offset)
+            except encoding.DECODE_ERRORS as e:
+                raise ValueError(f"bad header: {e}")
+            block_hash = block.Block.header_hash(timestamp, merkle_root, previous_hash, nonce, difficulty)
+            if height < len(self):
+                if bytes.fromhex(block_hash) != self._hashes[height]:
+                    raise ChainForked(height)
+                continue
+
+            if previous_hash != self.tip_hash():
+                raise ValueError(f"header {height} does not link to the one before it")
+            if difficulty < self.min_difficulty:
+                raise ValueError(f"header {height} has difficulty {difficulty}, below the minimum of {self.min_difficulty}")
+            if not block.Block.meets_target(block_hash, difficulty):
+                raise ValueError(f"header {height} has an invalid proof-of-work")
+            self._hashes.append(bytes.fromhex(block_hash))
+            self._merkle_roots.append(bytes.fromhex(merkle_root))
+            added += 1
+        return added
+
+    def truncate(self, height):
+        """Drop the headers from this height onwards (when the miner's chain has forked away from ours)"""
+        del self._hashes[max(height, 0):]
+        del self._merkle_roots[max(height, 0):]
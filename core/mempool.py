@@ -0,0 +1,247 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+# Default limits, a full mempool evicts its lowest fee-per-byte transactions to get back under both of these
+DEFAULT_MAX_COUNT = 100000
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+# How many evicted transaction IDs are remembered, so they aren't accepted (and gossiped) again straight away
+DEFAULT_EVICTED_MEMORY = 100000
+# Every eviction pushes the minimum fee rate to the evicted one's plus this (fee per byte), and it halves every MIN_FEE_HALF_LIFE seconds after
+INCREMENTAL_FEE_RATE = 0.001
+MIN_FEE_HALF_LIFE = 60.0
+# What happened to each transaction in a batch (one byte each in a miner's RESULTS reply)
+ACCEPTED = 0
+DUPLICATE = 1  # already in the pool or already confirmed
+REJECTED = 2   # too low a fee, too big, or evicted to make room
+
+class Mempool:
+    """
+    The miner's pool of unconfirmed transactions, ordered by fee (highest first, then first come first served)
+    Adding is O(log n) onto a heap, looking up or removing by ID is O(1) through a dict
+    Removing doesn't touch the heap, the entry is just left there and skipped when it comes up ("lazy deletion")
+    Everything goes through the one lock, which the miner also holds when it checks a transaction against its chain
+    It is limited by number of transactions and by bytes, when it goes over the lowest fee rate (fee per byte) ones are evicted
+    """
+    def __init__(self, max_count: int = DEFAULT_MAX_COUNT, max_bytes: int = DEFAULT_MAX_BYTES, min_fee_rate: float = 0.0, evicted_memory: int = DEFAULT_EVICTED_MEMORY):
+        self.lock = threading.RLock()
+        # Notified whenever a transaction is added, so the mining loop can wait for them instead of polling
+        self._changed = threading.Condition(self.lock)
+
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        # The fixed minimum relay fee rate, the dynamic one below never goes under it
+        self.min_fee_rate = min_fee_rate
+
+        # Everything is keyed by the raw 32 byte transaction ID (tx.txid)
+        # Heap of (-fee, seq, transaction ID), the sequence number stops two transactions with the same fee being compared
+        self._heap = []
+        # Heap of (fee rate, seq, transaction ID), the next one to evict is at the top
+        self._eviction_heap = []
+        self._seq = 0
+
+        # transaction ID -> (-fee, seq, transaction, size), an ID's heap entries are only live if its seq matches the one here
+        self._entries = {}
+        # short ID -> transaction, so compact blocks can be rebuilt from what is already in the pool
+        self._short_ids = {}
+        self.total_bytes = 0
+
+        # The dynamic minimum fee rate, raised on every eviction and decaying back down over time
+        self._rolling_min_fee_rate = 0.0
+        self._rolling_updated = time.monotonic()
+
+        # Recently evicted IDs (oldest first), a bounded set
+        self._evicted = OrderedDict()
+        self.evicted_memory = evicted_memory
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._entries
+
+    def get(self, transaction_id):
+        """The transaction with this ID, or None"""
+        entry = self._entries.get(transaction_id)
+        return entry[2] if entry is not None else None
+
+    def get_short(self, short_id):
+        """The transaction with this short ID, or None"""
+        return self._short_ids.get(short_id)
+
+    def was_evicted(self, transaction_id):
+        """True if the transaction was recently evicted for having too low a fee"""
+        return transaction_id in self._evicted
+
+    def current_min_fee_rate(self):
+        """The fee rate a new transaction needs right now, the dynamic minimum halves every MIN_FEE_HALF_LIFE seconds"""
+        with self.lock:
+            if self._rolling_min_fee_rate:
+                now = time.monotonic()
+                self._rolling_min_fee_rate *= 0.5 ** ((now - self._rolling_updated) / MIN_FEE_HALF_LIFE)
+                self._rolling_updated = now
+                # Once it has decayed to next to nothing, just drop it
+                if self._rolling_min_fee_rate < INCREMENTAL_FEE_RATE / 2:
+                    self._rolling_min_fee_rate = 0.0
+            return max(self.min_fee_rate, self._rolling_min_fee_rate)
+
+    def add(self, tx, enforce_min_fee: bool = True):
+        """
+        Add a transaction, returns False if it is already in the pool, was recently evicted, pays too low a fee rate
+        or was evicted itself straight away to get the pool back under its limits
+        Transactions put back from a dropped block skip the minimum fee (enforce_min_fee=False), but can still be evicted
+        """
+        with self.lock:
+            if not self._add(tx, tx.size(), enforce_min_fee):
+                return False
+            self._changed.notify_all()
+            return True
+
+    def add_batch(self, txs, confirmed=(), max_size: int | None = None):
+        """
+        Add a batch of transactions with the lock taken once, returns a result for each one (ACCEPTED, DUPLICATE or REJECTED)
+        confirmed is anything holding the IDs that are already in a block (they count as duplicates),
+        and a transaction bigger than max_size is rejected, the mining loop is only woken once at the end
+        """
+        results = []
+        with self.lock:
+            for tx in txs:
+                transaction_id = tx.txid
+                size = tx.size()
+                if transaction_id in self._entries or transaction_id in confirmed:
+                    results.append(DUPLICATE)
+                elif (max_size is not None and size > max_size) or not self._add(tx, size, True):
+                    results.append(REJECTED)
+                else:
+                    results.append(ACCEPTED)
+
+            # A later one in the batch can push an earlier one back out when the pool is full
+            for i, tx in enumerate(txs):
+                if results[i] == ACCEPTED and tx.txid not in self._entries:
+                    results[i] = REJECTED
+            if ACCEPTED in results:
+                self._changed.notify_all()
+        return results
+
+    def _add(self, tx, size, enforce_min_fee):
+        """Put a transaction in the pool and trim it back under its limits, returns False if it didn't stay in (the lock must be held)"""
+        transaction_id = tx.txid
+        if transaction_id in self._entries or transaction_id in self._evicted:
+            return False
+        fee_rate = tx.fee / size
+        if enforce_min_fee and fee_rate < self.current_min_fee_rate():
+            return False
+
+        entry = (-tx.fee, self._seq, tx, size)
+        self._seq += 1
+        self._entries[transaction_id] = entry
+        self._short_ids[tx.short_id()] = tx
+        self.total_bytes += size
+        heapq.heappush(self._heap, (entry[0], entry[1], transaction_id))
+        heapq.heappush(self._eviction_heap, (fee_rate, entry[1], transaction_id))
+
+        self._trim()
+        return transaction_id in self._entries
+
+    def wait_until(self, count: int, timeout: float | None = None):
+        """Block until the pool holds at least count transactions or the timeout passes, returns True if it got there"""
+        with self._changed:
+            return self._changed.wait_for(lambda: len(self._entries) >= count, timeout)
+
+    def _drop(self, transaction_id):
+        """Take a transaction out of the dict and short ID index, its heap entries go dead"""
+        entry = self._entries.pop(transaction_id, None)
+        if entry is None:
+            return None
+        self.total_bytes -= entry[3]
+        short_id = entry[2].short_id()
+        if self._short_ids.get(short_id) is entry[2]:
+            del self._short_ids[short_id]
+        return entry
+
+    def _trim(self):
+        """Evict the lowest fee rate transactions until the pool is under both limits"""
+        while self._entries and (len(self._entries) > self.max_count or self.total_bytes > self.max_bytes):
+            fee_rate, seq, transaction_id = heapq.heappop(self._eviction_heap)
+            entry = self._entries.get(transaction_id)
+            if entry is None or entry[1] != seq:
+                continue
+            self._drop(transaction_id)
+
+            # Remember it (forgetting the oldest if there are too many), and make the next one pay more than it did
+            self._evicted[transaction_id] = None
+            if len(self._evicted) > self.evicted_memory:
+                self._evicted.popitem(last=False)
+            self._rolling_min_fee_rate = max(self.current_min_fee_rate(), fee_rate + INCREMENTAL_FEE_RATE)
+            self._rolling_updated = time.monotonic()
+        self._compact()
+
+    def remove(self, transaction_ids):
+        """Remove transactions by ID (e.g. a block confirmed them), returns how many were in the pool"""
+        removed = 0
+        with self.lock:
+            for transaction_id in transaction_ids:
+                if self._drop(transaction_id) is not None:
+                    removed += 1
+            self._compact()
+        return removed
+
+    def _compact(self):
+        """Once most of the heaps are dead entries, rebuild them from the live ones so they don't keep growing"""
+        if len(self._heap) > 2 * len(self._entries) + 64 or len(self._eviction_heap) > 2 * len(self._entries) + 64:
+            self._heap = [(entry[0], entry[1], transaction_id) for transaction_id, entry in self._entries.items()]
+            self._eviction_heap = [(-entry[0] / entry[3], entry[1], transaction_id) for transaction_id, entry in self._entries.items()]
+            heapq.heapify(self._heap)
+            heapq.heapify(self._eviction_heap)
+
+    def _is_live(self, item):
+        entry = self._entries.get(item[2])
+        return entry is not None and entry[1] == item[1]
+
+    def _by_fee(self):
+        """
+        Yields the live entries highest fee first, without popping them off (the lock must be held)
+        A heap is a tree (the children of i are 2i+1 and 2i+2), so walk it best-first with a small heap of indices,
+        which only looks at about as many entries as are taken (plus any dead ones) instead of sorting the whole pool
+        """
+        heap = self._heap
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier:
+            item, i = heapq.heappop(frontier)
+            if self._is_live(item):
+                yield self._entries[item[2]]
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def top(self, k):
+        """The k highest fee transactions, without popping them off"""
+        selected = []
+        with self.lock:
+            for entry in self._by_fee():
+                if len(selected) >= k:
+                    break
+                selected.append(entry[2])
+        return selected
+
+    def select(self, max_bytes: int, max_misses: int = 100):
+        """
+        A block template, the highest fee transactions that fit in max_bytes (each one costs its size plus a separator)
+        One that doesn't fit is skipped for smaller ones after it, until max_misses in a row haven't fit
+        """
+        selected = []
+        used = 0
+        misses = 0
+        with self.lock:
+            for entry in self._by_fee():
+                size = entry[3] + 1
+                if used + size > max_bytes:
+                    misses += 1
+                    if misses >= max_misses:
+                        break
+                    continue
+                misses = 0
+                used += size
+                selected.append(entry[2])
+        return selected
@@ -0,0 +1,87 @@
+import binascii
+import hashlib
+from core import encoding
+
+# The merkle tree of a block's transactions, worked on as raw 32 byte hashes
+# The tree has always hashed the hex text of the two children joined together (sha256(left_hex + right_hex)),
+# so the parent of two raw hashes is sha256(hexlify(left + right)) and the roots come out exactly the same as before
+# An odd one out at the end of a layer is paired with itself (the duplicate-last rule)
+
+def next_layer(layer: list):
+    """Hash a layer into the one above it, a whole layer at a time (pairing the evens with the odds)"""
+    if len(layer) % 2:
+        layer = layer + [layer[-1]]
+    sha256 = hashlib.sha256
+    hexlify = binascii.hexlify
+    return [sha256(hexlify(left + right)).digest() for left, right in zip(layer[0::2], layer[1::2])]
+
+def build_layers(leaves: list):
+    """Every layer of the tree, the leaves first and the root (on its own) last"""
+    if not leaves:
+        raise ValueError("a merkle tree needs at least one leaf")
+    layers = [list(leaves)]
+    while len(layers[-1]) > 1:
+        layers.append(next_layer(layers[-1]))
+    return layers
+
+def root(leaves: list):
+    """The merkle root as raw bytes, without keeping the layers on the way up"""
+    if not leaves:
+        raise ValueError("a merkle tree needs at least one leaf")
+    layer = leaves
+    while len(layer) > 1:
+        layer = next_layer(layer)
+    return layer[0]
+
+def print_tree(layers: list):
+    """The verbose dump of a tree (leaves, root, then every layer from the root down), it is only printed when asked for"""
+    print(f"\nCreating merkle tree...")
+    print("\nLeaves (hashes):")
+    for i, h in enumerate(layers[0]):
+        print(f"    Leaf {i}: {h.hex()}")
+
+    print("\nMerkle root:", layers[-1][0].hex())
+
+    print("\nTree (from root to leaves):")
+    for depth, layer in enumerate(reversed(layers), start=0):
+        level = len(layers) - 1 - depth
+        print(f"    Layer {level} ({len(layer)} node(s)):")
+        for node in layer:
+            print(" ", node.hex())
+
+def proof(layers: list, index: int):
+    """
+    The inclusion proof for the leaf at index - the sibling hash at each layer on the way up to the root
+    (a node with no sibling at the end of an odd layer has itself as its sibling, like when the layer is hashed)
+    """
+    path = []
+    for layer in layers[:-1]:
+        sibling = index ^ 1
+        path.append(layer[sibling] if sibling < len(layer) else layer[index])
+        index //= 2
+    return path
+
+def verify(leaf: bytes, index: int, path: list, merkle_root: bytes):
+    """Check an inclusion proof, hashing the leaf up with its siblings must come out at the root"""
+    node = leaf
+    for sibling in path:
+        pair = sibling + node if index & 1 else node + sibling
+        node = hashlib.sha256(binascii.hexlify(pair)).digest()
+        index //= 2
+    return index == 0 and node == merkle_root
+
+def write_proof(out: bytearray, index: int, path: list):
+    """Append a proof in the binary encoding, the leaf's index then a count of 32 byte hashes"""
+    encoding.write_varint(out, index)
+    encoding.write_varint(out, len(path))
+    for node in path:
+        out += node
+
+def read_proof(view, offset: int):
+    """Returns (index, path, offset after it)"""
+    index, offset = encoding.read_varint(view, offset)
+    count, offset = encoding.read_varint(view, offset)
+    end = offset + 32 * count
+    if end > len(view):
+        raise ValueError("truncated merkle proof")
+    return index, [bytes(view[i:i + 32]) for i in range(offset, end, 32)], end
@@ -0,0 +1,124 @@
+import hashlib
+import multiprocessing
+import queue
+
+# These are the mining engines a Block can use to search for its nonce
+# The block hash is str(timestamp) + merkle_root + previous_hash + str(nonce) + str(difficulty),
+# so an engine only needs the part before the nonce (prefix) and the part after it (suffix)
+# The prefix never changes during a search, so it is hashed once into a sha256 object (the "midstate")
+# and each attempt only .copy()s that and feeds in the nonce and suffix bytes
+
+class MiningInterrupted(Exception):
+    """Raised when a nonce search is cancelled before it finds a hash (e.g. a peer's block got there first)"""
+
+
+def target_bytes(difficulty: int):
+    """The target (1 << (256 - difficulty)) as 32 big-endian bytes, so it can be compared against .digest() directly"""
+    if difficulty <= 0:
+        return b"\xff" * 33 # every 32 byte digest sorts below this
+    return (1 << (256 - difficulty)).to_bytes(32, "big")
+
+
+def _search_nonces(prefix: str, suffix: str, target: bytes, start: int, step: int, stop_event, result_queue):
+    """
+    Worker that hashes the nonces start, start + step, start + 2*step ... until one is below the target
+    or another worker tells it to stop (it lives at module level so multiprocessing can pickle it)
+    """
+    midstate = hashlib.sha256(prefix.encode())
+    suffix = suffix.encode()
+    nonce = start
+    attempts = 0
+    try:
+        while True:
+            h = midstate.copy()
+            h.update(b"%d%s" % (nonce, suffix))
+            attempts += 1
+            # Comparing the raw digest bytes is the same as comparing int(hexdigest, 16) but without the conversion
+            if h.digest() < target:
+                stop_event.set() # first one to find it cancels the others
+                result_queue.put((nonce, h.hexdigest(), attempts))
+                return
+            nonce += step
+
+            # Checking the event is a lot slower than a hash, so only look every few thousand tries
+            if attempts % 4096 == 0 and stop_event.is_set():
+                break
+    except KeyboardInterrupt:
+        pass
+    result_queue.put((None, None, attempts))
+
+
+class MiningEngine:
+    """
+    The default engine, a single process nonce search exactly like the original Block.mine loop
+    Returns (nonce, hash, attempts), or raises MiningInterrupted if the cancel event gets set
+    """
+    def search(self, prefix: str, suffix: str, difficulty: int, cancel=None):
+        target = target_bytes(difficulty)
+        midstate = hashlib.sha256(prefix.encode())
+        suffix = suffix.encode()
+        nonce = 0
+        while True:
+            h = midstate.copy()
+            h.update(b"%d%s" % (nonce, suffix))
+            if h.digest() < target:
+                return nonce, h.hexdigest(), nonce + 1 # realised to add one cause we start with a zero
+            nonce += 1
+
+            # A few thousand hashes is only a couple of milliseconds, so this is often enough to stop quickly
+            if cancel is not None and nonce % 4096 == 0 and cancel.is_set():
+                raise MiningInterrupted(f"Mining cancelled after {nonce} attempts")
+
+
+class ParallelMiningEngine(MiningEngine):
+    """
+    Splits the nonce space across a pool of worker processes so mining is not stuck on one core by the GIL
+    Worker i tries the nonces i, i + workers, i + 2*workers ... so no two workers ever hash the same nonce
+    """
+    def __init__(self, workers: int | None = None):
+        self.workers = workers or multiprocessing.cpu_count()
+
+    def search(self, prefix: str, suffix: str, difficulty: int, cancel=None):
+        target = target_bytes(difficulty)
+        stop_event = multiprocessing.Event()
+        result_queue = multiprocessing.Queue()
+
+        processes = []
+        for i in range(self.workers):
+            p = multiprocessing.Process(target=_search_nonces, args=(prefix, suffix, target, i, self.workers, stop_event, result_queue), daemon=True)
+            p.start()
+            processes.append(p)
+
+        # Every worker puts exactly one result on the queue, the winner's one has the nonce in it
+        found = None
+        attempts = 0
+        results = 0
+        try:
+            while results < len(processes):
+                # Wake up every few milliseconds to pass a cancel on to the workers
+                try:
+                    nonce, block_hash, worker_attempts = result_queue.get(timeout=0.005)
+                except queue.Empty:
+                    if cancel is not None and cancel.is_set():
+                        stop_event.set()
+                    continue
+                results += 1
+                attempts += worker_attempts
+                # Two workers can both find one before they see the event, so keep the lowest nonce
+                if nonce is not None and (found is None or nonce < found[0]):
+                    found = (nonce, block_hash)
+        finally:
+            stop_event.set()
+            for p in processes:
+                p.join()
+
+        if found is None:
+            raise MiningInterrupted(f"Mining cancelled after {attempts} attempts")
+        return found[0], found[1], attempts
+
+
+def get_engine(workers: int = 1):
+    """Pick the engine for the number of worker processes a miner wants"""
+    if workers is not None and workers <= 1:
+        return MiningEngine()
+    return ParallelMiningEngine(workers)
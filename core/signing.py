@@ -0,0 +1,46 @@
+import hashlib
+import os
+
+# Ed25519 signatures (RFC 8032) - a 32 byte private key (the "seed"), a 32 byte public key and 64 byte signatures
+# These come from the `cryptography` package (see requirements.txt), signing is not something to write by hand
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+except ImportError as e:
+    raise ImportError("transaction signing needs the cryptography package, install it with: pip install -r requirements.txt") from e
+
+PRIVATE_KEY_SIZE = 32
+PUBLIC_KEY_SIZE = 32
+SIGNATURE_SIZE = 64
+# An owner's address is this many hex characters of the SHA-256 of their public key (20 bytes, like Ethereum's)
+ADDRESS_LENGTH = 40
+
+def generate_private_key():
+    return os.urandom(PRIVATE_KEY_SIZE)
+
+def public_key(private_key: bytes):
+    """The public key for a private key"""
+    key = ed25519.Ed25519PrivateKey.from_private_bytes(private_key).public_key()
+    return key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+def address(public: bytes):
+    """
+    The address (owner name) for a public key, transactions from it have to be signed with that key
+    It comes from the key itself, so nobody can claim someone else's address before they have used it
+    """
+    return hashlib.sha256(public).hexdigest()[:ADDRESS_LENGTH]
+
+def sign(private_key: bytes, message: bytes):
+    """The 64 byte signature of message"""
+    return ed25519.Ed25519PrivateKey.from_private_bytes(private_key).sign(message)
+
+def verify(public: bytes, message: bytes, signature: bytes):
+    """True if signature is public's signature of message"""
+    if len(public) != PUBLIC_KEY_SIZE or len(signature) != SIGNATURE_SIZE:
+        return False
+    try:
+        ed25519.Ed25519PublicKey.from_public_bytes(public).verify(signature, message)
+        return True
+    except (InvalidSignature, ValueError):
+        return False
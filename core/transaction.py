@@ -1,20 +1,143 @@
 import time
 from utils import formatter
-import hash_function
+from core import encoding
+from core import hash_function
+from core import signing
+
+# Compact blocks refer to transactions by the first 12 hex characters (6 bytes) of their ID, which is plenty to tell
+# apart the transactions in one mempool, and if two ever clash the merkle root check catches it
+SHORT_ID_LENGTH = 12
+
+def parse_amount(amount: int | float | str):
+    """An amount as a number, text like "12" becomes an int and "12.5" a float, so str() of it is the text it came from"""
+    if isinstance(amount, str):
+        return encoding.parse_number(amount.strip())
+    return amount
 
 class Transaction:
-    def __init__(self, sender: str, receiver: str, amount: int | str, fee: int | float = 0):
+    # Slots instead of a __dict__ per transaction, a miner can be holding millions of them
+    __slots__ = ("sender", "receiver", "amount", "fee", "timestamp", "txid", "public_key", "signature")
+
+    def __init__(self, sender: str, receiver: str, amount: int | float | str, fee: int | float = 0, timestamp: float | None = None,
+                 public_key: bytes = b"", signature: bytes = b""):
         self.sender = sender
         self.receiver = receiver
-        self.amount = str(amount)
-        self.timestamp = time.time()
+        # Kept as a number rather than a string, str() of it is what goes into the ID
+        self.amount = parse_amount(amount)
+        # A transaction received over the network keeps its original timestamp, so it hashes to the same ID
+        self.timestamp = time.time() if timestamp is None else timestamp
         self.fee = float(fee)
 
-        # This is the data for the transaction used from a tutorial worksheet
-        self.data = formatter.data_helper(self.sender, self.receiver, self.amount, self.timestamp)
+        # Each transaction must have an ID, the hash of the data for the transaction used from a tutorial worksheet
+        # It is kept as the raw 32 bytes (transaction_id gives the hex), and the data string isn't kept at all
+        self.txid = hash_function.sha256_digest(formatter.data_helper(self.sender, self.receiver, str(self.amount), self.timestamp))
+
+        # The sender's Ed25519 public key and signature of signing_bytes(), empty if the transaction isn't signed
+        # They aren't part of the ID (a signature can't sign itself), the signature covers the ID and the fee instead
+        self.public_key = public_key
+        self.signature = signature
+
+    @classmethod
+    def from_fields(cls, sender: str, receiver: str, amount: str, fee: str, timestamp: str, transaction_id: str,
+                    public_key: str = "", signature: str = ""):
+        """
+        Rebuild a transaction someone else made (e.g. from a wallet's Transaction: line) from its fields as text,
+        keeping its original timestamp so it has the same ID everywhere
+        The ID is worked out once from the fields and has to match the one it came with, otherwise ValueError
+        The public key and signature come as hex (checking the signature is up to the miner's validation stage)
+        """
+        tx = cls(sender, receiver, parse_amount(amount), float(fee), encoding.parse_number(timestamp.strip()),
+                 bytes.fromhex(public_key.strip()), bytes.fromhex(signature.strip()))
+        if tx.transaction_id != transaction_id.strip().lower():
+            raise ValueError(f"transaction ID {transaction_id} does not match its contents")
+        return tx
+
+    def signing_bytes(self):
+        """What the sender signs - the ID (which covers sender, receiver, amount and timestamp) and the fee"""
+        return self.txid + str(self.fee).encode()
+
+    def sign(self, private_key: bytes):
+        """Sign the transaction with the sender's private key"""
+        self.public_key = signing.public_key(private_key)
+        self.signature = signing.sign(private_key, self.signing_bytes())
+
+    def verify_signature(self):
+        """True if the transaction is signed and the signature is right for its public key (see core/validation.py for the cached version)"""
+        return signing.verify(self.public_key, self.signing_bytes(), self.signature)
+
+    @property
+    def transaction_id(self):
+        """The transaction ID as hex"""
+        return self.txid.hex()
+
+    def short_id(self):
+        """The shortened transaction ID used in compact blocks"""
+        return self.txid[:SHORT_ID_LENGTH // 2].hex()
+
+    def size(self):
+        """How many bytes the transaction takes up encoded, used for fee rates and the mempool's byte limit"""
+        return len(self.to_bytes())
+
+    def write(self, out: bytearray):
+        """
+        Append the binary encoding - sender and receiver (length-prefixed), amount, fee and timestamp (see core/encoding.py),
+        then the public key and signature (length-prefixed, empty if unsigned)
+        The ID isn't sent, it is worked out again from the rest when the transaction is read back
+        """
+        encoding.write_str(out, self.sender)
+        encoding.write_str(out, self.receiver)
+        encoding.write_number(out, str(self.amount))
+        encoding.write_number(out, str(self.fee))
+        encoding.write_number(out, str(self.timestamp))
+        encoding.write_bytes(out, self.public_key)
+        encoding.write_bytes(out, self.signature)
+
+    def to_bytes(self):
+        out = bytearray()
+        self.write(out)
+        return bytes(out)
+
+    @classmethod
+    def read(cls, view, offset: int = 0, version: int = encoding.VERSION):
+        """
+        Read one transaction from a bytes/memoryview at offset, returns (transaction, offset after it)
+        version is the version byte of whatever it is in, version 1 transactions have no public key or signature
+        """
+        sender, offset = encoding.read_str(view, offset)
+        receiver, offset = encoding.read_str(view, offset)
+        amount, offset = encoding.read_number(view, offset)
+        fee, offset = encoding.read_number(view, offset)
+        timestamp, offset = encoding.read_number(view, offset)
+        public_key = signature = b""
+        if version >= 2:
+            public_key, offset = encoding.read_bytes(view, offset)
+            signature, offset = encoding.read_bytes(view, offset)
+        # The original timestamp is kept, so the ID comes out the same
+        return cls(sender, receiver, parse_amount(amount), float(fee), encoding.parse_number(timestamp), public_key, signature), offset
+
+    @staticmethod
+    def list_to_bytes(transactions):
+        """A versioned, count-prefixed list of transactions"""
+        out = bytearray([encoding.VERSION])
+        encoding.write_varint(out, len(transactions))
+        for tx in transactions:
+            tx.write(out)
+        return bytes(out)
 
-        # Each transaction must have an ID
-        self.transaction_id = hash_function.sha256(self.data)
+    @classmethod
+    def list_from_bytes(cls, data):
+        """Read a list_to_bytes() list, raises ValueError if it is cut short or not a version we know"""
+        view = memoryview(data)
+        try:
+            version, offset = encoding.read_version(view, 0)
+            count, offset = encoding.read_varint(view, offset)
+            transactions = []
+            for _ in range(count):
+                tx, offset = cls.read(view, offset, version)
+                transactions.append(tx)
+        except encoding.DECODE_ERRORS as e:
+            raise ValueError(f"bad transaction list: {e}")
+        return transactions
 
     # Making the print/string format of the classes object
     def __str__(self):
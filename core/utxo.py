@@ -0,0 +1,197 @@
+import bisect
+import os
+import struct
+import threading
+from core import encoding
+
+# A saved UTXOIndex (see UTXOIndex.save) - the version byte, how many blocks it covers and the hash of the last one,
+# then the balances (owner, signed units) and the transaction heights (raw ID, height)
+CHECKPOINT_HEADER = struct.Struct(">BQ32s")
+CHECKPOINT_BALANCE = struct.Struct(">q")
+CHECKPOINT_HEIGHT = struct.Struct(">32sQ")
+
+class UTXOSet:
+    """
+    A wallet's unspent transactions (UTXOs), keyed by the raw 32 byte transaction ID (tx.txid)
+    Looking one up, adding or spending it is a dict operation plus a bisect into a list kept sorted by amount,
+    and the balance is kept as a running total, so nothing has to go through every UTXO (exchange wallets can have 100k+)
+    Spent IDs are remembered, so rescanning the chain (e.g. after a reorg) doesn't bring spent coins back
+    It has its own lock, the wallet's monitor thread adds to it while the wallet loop spends from it
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        # transaction ID -> transaction
+        self._utxos = {}
+        # (amount, transaction ID) sorted smallest first, for coin selection
+        self._by_amount = []
+        self._spent = set()
+        # The balance in units of 0.00000001 (like the binary encoding), so adding and taking away amounts doesn't drift
+        self._balance_units = 0
+
+    def __len__(self):
+        return len(self._utxos)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._utxos
+
+    def __iter__(self):
+        """The UTXOs, largest amount first (a snapshot, so the set can change while it is being looked through)"""
+        with self._lock:
+            utxos = [self._utxos[transaction_id] for _, transaction_id in reversed(self._by_amount)]
+        return iter(utxos)
+
+    @property
+    def balance(self):
+        return self._balance_units / encoding.UNITS
+
+    def add(self, tx):
+        """Add a UTXO, returns False if we already have it or it has been spent"""
+        transaction_id = tx.txid
+        with self._lock:
+            if transaction_id in self._utxos or transaction_id in self._spent:
+                return False
+            self._utxos[transaction_id] = tx
+            bisect.insort(self._by_amount, (tx.amount, transaction_id))
+            self._balance_units += round(tx.amount * encoding.UNITS)
+            return True
+
+    def remove(self, transaction_id):
+        """Take a UTXO out without marking it spent (e.g. undoing change that was never sent), returns it or None"""
+        with self._lock:
+            tx = self._utxos.pop(transaction_id, None)
+            if tx is None:
+                return None
+            i = bisect.bisect_left(self._by_amount, (tx.amount, transaction_id))
+            del self._by_amount[i]
+            self._balance_units -= round(tx.amount * encoding.UNITS)
+            return tx
+
+    def spend(self, txs):
+        """Take these UTXOs out and remember they are spent"""
+        with self._lock:
+            for tx in txs:
+                if self.remove(tx.txid) is not None:
+                    self._spent.add(tx.txid)
+
+    def unspend(self, txs):
+        """Put spent UTXOs back (the transaction spending them never made it to a miner)"""
+        with self._lock:
+            for tx in txs:
+                self._spent.discard(tx.txid)
+                self.add(tx)
+
+    def select(self, cost):
+        """
+        The largest UTXOs first until they add up to at least cost, or None if the balance isn't enough
+        Only as many UTXOs are looked at as are selected
+        """
+        selected = []
+        funds = 0
+        with self._lock:
+            if self.balance < cost:
+                return None
+            for _, transaction_id in reversed(self._by_amount):
+                if funds >= cost:
+                    break
+                tx = self._utxos[transaction_id]
+                selected.append(tx)
+                funds += float(tx.amount)
+        return selected if funds >= cost else None
+
+class UTXOIndex:
+    """
+    A miner's index of its own chain, kept up to date a block at a time as blocks go on the end and undone in a reorg
+    A transaction has no inputs (just sender, receiver and amount), so each confirmed transaction is an output to its receiver
+    and an owner's balance is what they have been paid minus what they have sent (amount plus fee), all as running totals
+    It also maps every confirmed transaction ID to its block's height, so a miner can tell a transaction is already confirmed
+    without going through the chain
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        # transaction ID -> height of the block it is in
+        self._heights = {}
+        # owner -> balance in units of 0.00000001
+        self._balances = {}
+        # How many blocks have been applied, the index matches the chain up to here
+        self.length = 0
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._heights
+
+    def height_of(self, transaction_id):
+        """The height of the block that confirmed this transaction, or None"""
+        return self._heights.get(transaction_id)
+
+    def balance(self, owner):
+        """The owner's confirmed balance, a single dict lookup"""
+        return self._balances.get(owner, 0) / encoding.UNITS
+
+    def save(self, path, tip_hash):
+        """
+        Write the index to path as a checkpoint of the chain up to the block with tip_hash (its last block),
+        to a temporary file first and then moved over the old one, so a crash part way through leaves the old checkpoint
+        """
+        with self._lock:
+            out = bytearray(CHECKPOINT_HEADER.pack(encoding.VERSION, self.length, encoding.hash_bytes(tip_hash)))
+            encoding.write_varint(out, len(self._balances))
+            for owner, units in self._balances.items():
+                encoding.write_str(out, owner)
+                out += CHECKPOINT_BALANCE.pack(units)
+            encoding.write_varint(out, len(self._heights))
+            out += b"".join(CHECKPOINT_HEIGHT.pack(transaction_id, height) for transaction_id, height in self._heights.items())
+        with open(path + ".tmp", "wb") as f:
+            f.write(out)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a save(), returns (index, the tip hash it was saved at), or (None, None) if there isn't a good one"""
+        try:
+            with open(path, "rb") as f:
+                view = memoryview(f.read())
+            version, length, tip_hash = CHECKPOINT_HEADER.unpack_from(view, 0)
+            if version not in encoding.SUPPORTED_VERSIONS:
+                return None, None
+            index = cls()
+            index.length = length
+            offset = CHECKPOINT_HEADER.size
+            count, offset = encoding.read_varint(view, offset)
+            for _ in range(count):
+                owner, offset = encoding.read_str(view, offset)
+                index._balances[owner] = CHECKPOINT_BALANCE.unpack_from(view, offset)[0]
+                offset += CHECKPOINT_BALANCE.size
+            count, offset = encoding.read_varint(view, offset)
+            if offset + count * CHECKPOINT_HEIGHT.size != len(view):
+                return None, None
+            index._heights = dict(CHECKPOINT_HEIGHT.iter_unpack(view[offset:]))
+        except (OSError, ValueError) + encoding.DECODE_ERRORS:
+            return None, None
+        return index, tip_hash.hex()
+
+    def _credit(self, owner, units):
+        balance = self._balances.get(owner, 0) + units
+        if balance:
+            self._balances[owner] = balance
+        else:
+            self._balances.pop(owner, None)
+
+    def apply(self, blk):
+        """Add the next block on the chain"""
+        with self._lock:
+            for tx in blk.data:
+                amount = round(tx.amount * encoding.UNITS)
+                self._heights[tx.txid] = self.length
+                self._credit(tx.receiver, amount)
+                self._credit(tx.sender, -amount - round(tx.fee * encoding.UNITS))
+            self.length += 1
+
+    def undo(self, blk):
+        """Take the last block back off (it has to be the last one applied)"""
+        with self._lock:
+            self.length -= 1
+            for tx in reversed(blk.data):
+                amount = round(tx.amount * encoding.UNITS)
+                if self._heights.get(tx.txid) == self.length:
+                    del self._heights[tx.txid]
+                self._credit(tx.receiver, -amount)
+                self._credit(tx.sender, amount + round(tx.fee * encoding.UNITS))
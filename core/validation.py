@@ -0,0 +1,83 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from core import signing
+
+# How many verified transactions are remembered, so one checked on its way into the mempool isn't checked again when its block arrives
+VERIFIED_CACHE_SIZE = 100000
+# Batches smaller than this are checked in this process, handing them to the pool would cost more than it saves
+POOL_MIN_BATCH = 64
+
+def _verify_batch(items):
+    """Check a list of (public key, message, signature), at module level so the process pool can run it"""
+    return [signing.verify(public, message, signature) for public, message, signature in items]
+
+class SignatureVerifier:
+    """
+    Checks transaction signatures in batches, remembering the ones that were good (a bounded LRU, oldest forgotten first)
+    A transaction is only a cache hit if its public key, signature and fee are the same as the one that was checked,
+    so the same ID with a different signature (or fee) is checked again
+    A big batch is split across a process pool (one worker per CPU unless workers says otherwise, 1 keeps it in this process),
+    like the mining engine splits the nonce search
+    """
+    def __init__(self, workers: int | None = None, cache_size: int = VERIFIED_CACHE_SIZE):
+        workers = workers or os.cpu_count() or 1
+        self.workers = workers
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        # transaction ID -> (public key, signature, fee) that verified
+        self._verified = OrderedDict()
+        self._pool = ProcessPoolExecutor(workers) if workers > 1 else None
+
+        # Counters, for seeing how much the cache saves
+        self.hits = 0
+        self.checked = 0
+
+    def _cached(self, tx):
+        entry = self._verified.get(tx.txid)
+        if entry is not None and entry == (tx.public_key, tx.signature, tx.fee):
+            self._verified.move_to_end(tx.txid)
+            return True
+        return False
+
+    def _remember(self, tx):
+        self._verified[tx.txid] = (tx.public_key, tx.signature, tx.fee)
+        self._verified.move_to_end(tx.txid)
+        if len(self._verified) > self.cache_size:
+            self._verified.popitem(last=False)
+
+    def verify(self, txs):
+        """Returns whether each transaction's signature is good, only the ones not already in the cache are checked"""
+        results = [False] * len(txs)
+        unchecked = []
+        with self._lock:
+            for i, tx in enumerate(txs):
+                if self._cached(tx):
+                    results[i] = True
+                else:
+                    unchecked.append(i)
+            self.hits += len(txs) - len(unchecked)
+            self.checked += len(unchecked)
+        if not unchecked:
+            return results
+
+        items = [(txs[i].public_key, txs[i].signing_bytes(), txs[i].signature) for i in unchecked]
+        if self._pool is not None and len(items) >= POOL_MIN_BATCH:
+            # One chunk per worker
+            size = -(-len(items) // self.workers)
+            chunks = self._pool.map(_verify_batch, [items[i:i + size] for i in range(0, len(items), size)])
+            verified = [ok for chunk in chunks for ok in chunk]
+        else:
+            verified = _verify_batch(items)
+
+        with self._lock:
+            for i, ok in zip(unchecked, verified):
+                if ok:
+                    self._remember(txs[i])
+                    results[i] = True
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
@@ -104,12 +104,15 @@ if __name__ == "__main__":
         # Create the wallet
         wallet = wallet.Wallet(wallet_name)
         
+        # Other wallets pay this one at its address (it comes from the wallet's key)
+        print(f"\n[Wallet {wallet_name}] Your address is {wallet.address}")
+
         # I will give an initial 100 Bitcoin coins
         bitcoin_coins = 100
 
         print(f"\n[Wallet {wallet_name}] Receiving {bitcoin_coins} Bitcoins from Genesis")
 
-        genesis_tx = transaction.Transaction("Genesis", wallet_name, bitcoin_coins, 0)
+        genesis_tx = transaction.Transaction("Genesis", wallet.address, bitcoin_coins, 0)
         wallet.add_transaction(genesis_tx)
         
         print(f"\n[Wallet {wallet_name}] You now start with {wallet.wallet_balance()} Bitcoins")
@@ -1,88 +1,126 @@
-import threading
+import asyncio
 from utils import formatter
-import socket
 
 class Bootstrap:
     """
     Creating a bootstrapping node
     A bootstrapping node is a node that provides the initial configuration info to new nodes to join the network
     The new nodes that use it to connect to the network are the "Miners"
-    Multiple miners can connect to it in parallel to this node
+    Multiple miners can connect to it in parallel to this node, every connection is a coroutine on one asyncio event loop
     """
     def __init__(self, host: str = "127.0.0.1", port: int = 8333):
         self.host = host
         self.port = port
 
-        self._registry_lock = threading.Lock()
-        self._registry = []
+        # Everything runs on the one event loop, so the registry doesn't need a lock any more
+        # (miner, host, port) -> entry, a dict keeps the order they registered in and makes register/deregister/lookup O(1)
+        self._registry = {}
 
-    def bootstrap_handler(self, conn, addr):
-        with conn:
+        # The LIST reply is built once and reused until a miner registers or leaves
+        self._list_snapshot = None
+
+        # Registration connections that sent SUBSCRIBE, they get pushed a JOIN/LEAVE line whenever the membership changes
+        self._subscribers = set()
+
+    def register(self, name: str, host: str, port: int, writer):
+        """Add a miner to the registry (replacing an older registration of the same miner)"""
+        key = (name, host, port)
+        # Pop it first so a re-registered miner goes to the end, like it used to with the list
+        self._registry.pop(key, None)
+        self._registry[key] = {"miner": name, "host": host, "port": port, "writer": writer}
+        self._list_snapshot = None
+        self.notify_subscribers(f"JOIN {name} {host} {port}")
+
+    def deregister(self, name: str, host: str, port: int, writer):
+        """Remove a miner from the registry, unless it has since registered again on a newer connection"""
+        key = (name, host, port)
+        entry = self._registry.get(key)
+        if entry is not None and entry["writer"] is writer:
+            del self._registry[key]
+            self._list_snapshot = None
+            self.notify_subscribers(f"LEAVE {name} {host} {port}")
+
+    def notify_subscribers(self, line: str):
+        """Push a membership change to every subscribed miner"""
+        for subscriber in self._subscribers:
+            formatter.write_line(subscriber, line)
+
+    def subscribe(self, writer):
+        """Subscribe a registration connection to membership changes, it is sent a JOIN for every current miner to start with"""
+        self._subscribers.add(writer)
+        writer.write("".join(f'JOIN {e["miner"]} {e["host"]} {e["port"]}\n' for e in self._registry.values()).encode("utf-8"))
+
+    def list_snapshot(self):
+        """The LIST reply (one line per miner then END) as bytes, only rebuilt when the membership changed"""
+        if self._list_snapshot is None:
+            lines = [f'{e["miner"]} {e["host"]} {e["port"]}\n' for e in self._registry.values()]
+            lines.append("END\n")
+            self._list_snapshot = "".join(lines).encode("utf-8")
+        return self._list_snapshot
+
+    async def bootstrap_handler(self, reader, writer):
+        try:
             # Line is the string received at the bootstrap node's socket
             # It will be a command to either register a new miner or list current miner info
-            line = formatter.receive_line(conn) # command will either be REGISTER or LIST
+            line = await formatter.read_line(reader) # command will either be REGISTER or LIST
             if not line:
                 return
             parts = line.strip().split()
-            command = parts[0].upper()
+            command = parts[0].upper() if parts else ""
 
             # If it is a miner wanting to register
             if command == "REGISTER" and len(parts) == 4:
                 # Set the registration information of a miner into variables
                 name, host, port_str = parts[1], parts[2], parts[3]
-                
+
                 # Attempt to associate their port to the network
                 try:
                     port = int(port_str)
                 except ValueError:
-                    formatter.send_line(conn, "ERR invalid port")
+                    formatter.write_line(writer, "ERR invalid port")
                     return
-                with self._registry_lock:
-                    # This is the new miner's details
-                    entry = {"miner": name, "host": host, "port": port}
-                    # If the miner and his details do not already exist in the registry, then append them
-                    self._registry[:] = [e for e in self._registry if not (e["miner"] == name and e["host"] == host and e["port"] == port)]
-                    self._registry.append(entry)
+                self.register(name, host, port, writer)
 
                 # Inform the miner that all is OK
-                formatter.send_line(conn, "OK")
-                formatter.receive_line(conn)
+                formatter.write_line(writer, "OK")
+
+                # The miner stays registered for as long as this connection is open (waiting here doesn't hold a thread)
+                # It can send SUBSCRIBE on it to have membership changes pushed to it instead of polling LIST
+                try:
+                    while True:
+                        line = await formatter.read_line(reader)
+                        if not line:
+                            break
+                        if line.strip().upper() == "SUBSCRIBE":
+                            self.subscribe(writer)
+                finally:
+                    self._subscribers.discard(writer)
+                    self.deregister(name, host, port, writer)
 
-                with self._registry_lock:
-                    self._registry[:] = [e for e in self._registry if not (e["miner"] == name and e["host"] == host and e["port"] == port)]
-            
             # Else if the miner wants to get the list of all other miner's information
             elif command == "LIST":
-                with self._registry_lock:
-                    entries = list(self._registry)
-                for e in entries:
-                    formatter.send_line(conn, f'{e["miner"]} {e["host"]} {e["port"]}')
-                formatter.send_line(conn, "END")
+                writer.write(self.list_snapshot())
+                await writer.drain()
             else:
-                formatter.send_line(conn, "ERR unknown command")
-
-    def run_bootstrap(self):
-        """Start running the bootstrap node server"""
-        # Set the socket to TCP and IPv4, alongside other socket options
-        bootstrap_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        bootstrap_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        # Bind the socket to the host and port
-        bootstrap_socket.bind((self.host, self.port))
+                formatter.write_line(writer, "ERR unknown command")
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
 
-        # Start listening to connections
-        bootstrap_socket.listen()
+    async def serve(self):
+        """Start the bootstrap node server and serve until it is stopped"""
+        # TCP and IPv4, bound to the host and port with SO_REUSEADDR like before
+        server = await asyncio.start_server(self.bootstrap_handler, self.host, self.port, reuse_address=True, backlog=1024)
 
         print(f"\n[Bootstrap Node] Listening on {self.host}:{self.port}")
 
-        try:
-            while True:
-                # Now we start accepting incoming connections
-                conn, addr = bootstrap_socket.accept()
+        async with server:
+            await server.serve_forever()
 
-                # Thread each one
-                threading.Thread(target=self.bootstrap_handler, args=(conn, addr), daemon=True).start()
+    def run_bootstrap(self):
+        """Start running the bootstrap node server"""
+        try:
+            asyncio.run(self.serve())
         except KeyboardInterrupt:
             print("\n[Bootstrap Node] Shutting down")
-        finally:
-            bootstrap_socket.close()
\ No newline at end of file
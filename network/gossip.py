@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+
+# New transaction IDs are collected for this long and then announced to each peer in one INV
+GOSSIP_INTERVAL = 0.1
+# The most IDs in one INV or GETDATA (32 bytes each)
+MAX_INV_SIZE = 10000
+# How many IDs are remembered per peer as ones it already has, so they aren't announced back to it
+KNOWN_MEMORY = 100000
+# A transaction asked for with GETDATA isn't asked for again (from another peer) until this many seconds have gone by
+REQUEST_TIMEOUT = 5.0
+
+class PeerInventory:
+    """What one peer is known to have (a bounded set, oldest forgotten first) and the IDs waiting to be announced to it"""
+    def __init__(self):
+        self.known = OrderedDict()
+        self.pending = []
+
+    def mark_known(self, transaction_id):
+        """Returns False if the peer was already known to have it"""
+        if transaction_id in self.known:
+            return False
+        self.known[transaction_id] = None
+        if len(self.known) > KNOWN_MEMORY:
+            self.known.popitem(last=False)
+        return True
+
+class Gossip:
+    """
+    Transaction gossip by inventory - instead of every transaction being written to every peer as soon as it arrives,
+    its ID is queued for each peer that doesn't already have it, and every GOSSIP_INTERVAL the miner's sender task
+    announces each peer's queue as one INV. A peer only asks (GETDATA) for the IDs it hasn't seen, and gets them in one TXBATCH
+    Queueing is just appending to lists under a lock, so taking in transactions never waits on a peer's socket
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # peer name -> PeerInventory
+        self._peers = {}
+        # transaction ID -> when we asked a peer for it, oldest first
+        self._requested = OrderedDict()
+
+    def add_peer(self, name):
+        """A new connection to a peer starts with nothing known about it"""
+        with self._lock:
+            self._peers[name] = PeerInventory()
+
+    def remove_peer(self, name):
+        with self._lock:
+            self._peers.pop(name, None)
+
+    def mark_known(self, name, transaction_ids):
+        """The peer has these (it announced or sent them to us), so they don't need announcing to it"""
+        with self._lock:
+            peer = self._peers.get(name)
+            if peer is not None:
+                for transaction_id in transaction_ids:
+                    peer.mark_known(transaction_id)
+
+    def queue(self, transaction_ids, exclude=None):
+        """Queue new transactions to be announced to every peer (apart from exclude) that isn't known to have them"""
+        with self._lock:
+            for name, peer in self._peers.items():
+                if name == exclude:
+                    continue
+                for transaction_id in transaction_ids:
+                    if peer.mark_known(transaction_id):
+                        peer.pending.append(transaction_id)
+
+    def take_pending(self):
+        """Empty every peer's queue, returns peer name -> the IDs to announce to it"""
+        with self._lock:
+            pending = {}
+            for name, peer in self._peers.items():
+                if peer.pending:
+                    pending[name] = peer.pending
+                    peer.pending = []
+            return pending
+
+    def request(self, transaction_ids):
+        """Of the IDs we want, the ones that aren't already being fetched from some peer (they are marked as being fetched now)"""
+        now = time.monotonic()
+        with self._lock:
+            # Forget requests that have timed out, so they can be asked for again
+            while self._requested and next(iter(self._requested.values())) < now - REQUEST_TIMEOUT:
+                self._requested.popitem(last=False)
+            wanted = []
+            for transaction_id in transaction_ids:
+                if transaction_id not in self._requested:
+                    self._requested[transaction_id] = now
+                    wanted.append(transaction_id)
+            return wanted
+
+    def received(self, transaction_ids):
+        """These have arrived, so they are no longer being fetched"""
+        with self._lock:
+            for transaction_id in transaction_ids:
+                self._requested.pop(transaction_id, None)
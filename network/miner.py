@@ -1,10 +1,28 @@
+import asyncio
+import os
 import threading
-import queue
 from utils import formatter
+from network import gossip
+from network import outbound
 from core import transaction
-import time
-import socket
 from core import block
+from core import blockstore
+from core import encoding
+from core import mempool
+from core import merkle
+from core import mining
+from core import signing
+from core import utxo
+from core import validation
+
+# The most blocks sent back for one GET_BLOCKS range request between miners
+SYNC_BATCH_SIZE = 500
+# The most headers sent back for one GET_HEADERS request from a wallet (83 bytes each)
+HEADERS_BATCH_SIZE = 2000
+# The most blocks looked through for one GET_TXS request from a light wallet, it asks again for the rest
+OWNER_SCAN_LIMIT = 2000
+# The UTXO index is saved next to the chain every this many blocks (and when the miner stops)
+UTXO_CHECKPOINT_INTERVAL = 1000
 
 class Miner:
     """
@@ -12,8 +30,11 @@ class Miner:
     Connects to other peers within the network (Peer2Peer),
     Allows a wallet to connect with itself and submit transactions,
     The miner will broadcast all of these transactions to the network
+    All of the networking (listener, peers and wallets) runs on one asyncio event loop, mining runs off it in an executor thread
     """
-    def __init__(self, name: str, host: str = "127.0.0.1", port: int = 9101, bootstrap_host: str = "127.0.0.1", bootstrap_port: int = 8333, difficulty: int = 3, trans_per_block: int = 4):
+    def __init__(self, name: str, host: str = "127.0.0.1", port: int = 9101, bootstrap_host: str = "127.0.0.1", bootstrap_port: int = 8333, difficulty: int = 3, trans_per_block: int = 4, mining_workers: int = 1,
+                 max_block_bytes: int = block.MAX_BLOCK_BYTES, block_timeout: float = 10.0, mempool_max_count: int = mempool.DEFAULT_MAX_COUNT, mempool_max_bytes: int = mempool.DEFAULT_MAX_BYTES, min_relay_fee_rate: float = 0.0,
+                 data_dir: str | None = None, verify_workers: int | None = None, legacy_height: int = 0, min_difficulty: int | None = None):
         self.name = name
 
         # Storing the host and port of the miner
@@ -26,74 +47,440 @@ class Miner:
 
         # Define and manage peers (other miners on the network)
         self._peers_lock = threading.Lock()
-        self._peers = {} # miner name -> socket
-
-        # Define and manage the miner's mempool
-        self._mempool_lock = threading.Lock()
-        self._mempool = queue.PriorityQueue() # Priority queue as taught
-
-        # Ensure that 2 transactions with the same fee won't crash the PriorityQueue
-        self._mempool_seq = 0
-        self._seq_lock = threading.Lock()
-
-        # I ended up doing this over being scared about duplicate transactions and error handling
-        self._transaction_ids = set()
+        self._peers = {} # miner name -> its outbound queue (an outbound.PeerWriter, used like the StreamWriter it wraps)
+        # New transactions are announced to peers by ID in batches (INV), peers ask for the ones they don't have
+        self._gossip = gossip.Gossip()
+
+        # Define and manage the miner's mempool, highest fee first with lookups by ID and short ID
+        # Transactions stay in it while they are being mined and only leave once a block confirms them,
+        # so a compact block from a peer can be rebuilt without the transactions being sent again
+        # It is capped by count and bytes, evicting the lowest fee-per-byte transactions and raising its minimum fee when full
+        self._mempool = mempool.Mempool(mempool_max_count, mempool_max_bytes, min_relay_fee_rate)
+        # Compact blocks that are waiting on transactions we asked the peer for (block hash -> what we have so far)
+        self._pending_blocks = {}
 
         # I have to make a lock to the blockchain, since my own miner has multiple threads wanting to read/write
         self._blockchain_lock = threading.Lock()
-        self._blockchain = [] # I realised that a list works, of blocks that are then 'linked' to one another
-
-        # I need to dictate the number of transactions per block
+        # The chain lives on disk (data_dir, blockchain_data/<name> by default) so a restarted miner carries on where it stopped,
+        # it is used like the list of 'linked' blocks it used to be, but only the index is loaded at startup
+        self._blockchain = blockstore.BlockStore(data_dir or os.path.join("blockchain_data", name))
+        # Every confirmed transaction ID and each owner's balance, kept in step with the chain
+        # It is loaded from its last checkpoint and only the blocks since then are applied again
+        self._utxo_index_path = os.path.join(self._blockchain.directory, "utxo_index.dat")
+        self._utxo_index = self.load_utxo_index()
+        if len(self._blockchain):
+            print(f"\n[Miner {self.name}] Loaded blockchain from disk, length: {len(self._blockchain)}")
+
+        # Transaction signatures are checked in batches (across verify_workers processes, one per CPU by default) and the good ones
+        # remembered, so a transaction checked on its way into the mempool isn't checked again when a block with it is mined or arrives
+        self._verifier = validation.SignatureVerifier(verify_workers)
+        # Blocks below this height were mined before transactions were signed, so their transactions aren't checked
+        # (every miner on a network whose chain has blocks from then has to be started with the same legacy_height)
+        self.legacy_height = legacy_height
+
+        # Set this to stop the block currently being mined (it gets replaced for every new block)
+        self._mining_cancel = threading.Event()
+
+        # I need to dictate the number of transactions a block waits for, it gets mined with fewer once block_timeout runs out
         self.min_trans = trans_per_block
+        self.block_timeout = block_timeout
+        # A block takes as many of the highest fee transactions as fit in this many bytes
+        self.max_block_bytes = max_block_bytes
         # Also set the miner's difficulty in which he inputs into his block
         self.difficulty = difficulty
+        # The lowest difficulty a block from a peer can have (the network's, the same as our own unless it is given),
+        # otherwise a peer could send blocks that declare a target low enough to cost nothing
+        self.min_difficulty = difficulty if min_difficulty is None else min_difficulty
+        # How many processes the nonce search is split across (1 keeps it in the mining thread)
+        self.mining_engine = mining.get_engine(mining_workers)
 
-        # Set up the listening socket for the miner
+        # Set up the listening server for the miner
         self.listener = None
-        # Through trial and error, I realise you need a registration socket (bootstrap node's socket)
-        self.bootstrap_socket = None
+        # Through trial and error, I realise you need a registration connection (to the bootstrap node)
+        self.bootstrap_writer = None
         # I need a variable again to flag whether this is running or not
         self.running = False
 
+        # The event loop the networking runs on, and the tasks on it (asyncio only keeps weak references to tasks)
+        self.loop = None
+        self._tasks = set()
+
     def peer_names(self):
         """Returns the list of peers on the network (by miner name)"""
         with self._peers_lock:
             return list(self._peers.keys())
 
-    def add_peer(self, name, sock):
-        """Update the socket of a known miner or else add the miner"""
+    def add_peer(self, name, writer):
+        """
+        Update the connection of a known miner or else add the miner
+        Everything for the peer goes through its own outbound queue and writer task from now on, which is returned
+        """
+        peer_writer = outbound.PeerWriter(self.name, name, writer)
         with self._peers_lock:
             old = self._peers.get(name)
-            self._peers[name] = sock
-            if old and old is not sock:
-                try: old.close()
-                except: pass
+            self._peers[name] = peer_writer
+            self._gossip.add_peer(name)
+        if old:
+            old.close()
+        return peer_writer
 
     def get_sockets(self):
-        """Return the list of all sockets known to be owned by fellow peers/miners"""
+        """Return the list of all connections known to be owned by fellow peers/miners"""
         with self._peers_lock:
             return list(self._peers.items())
         
-    def remove_peer(self, name):
-        """Remove a peer from the network miner information"""
+    def remove_peer(self, name, writer=None):
+        """Remove a peer from the network miner information (only if it is still on that connection, when one is given)"""
         with self._peers_lock:
             # If the name doesnt exist in the peers dict, then return None instead of a KeyError
-            s = self._peers.pop(name, None)
-            if s:
-                try: s.close()
-                except: pass
+            current = self._peers.get(name)
+            if current is None or (writer is not None and current is not writer):
+                return
+            del self._peers[name]
+            self._gossip.remove_peer(name)
+        current.close()
+
+    def in_event_loop(self):
+        """True when called from the event loop's own thread (and not e.g. the mining thread)"""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def broadcast_peers(self, line, exclude=None, frame=None, key=None, droppable=False):
+        """
+        Function will send a lines into the network for each peer's connection (apart from the excluded peer),
+        followed by a frame if the message has a binary payload
+        It only queues the message on each peer's outbound queue (with a coalesce key and whether it can be dropped, see PeerWriter),
+        so a slow peer doesn't hold up the others
+        It is safe to call from the mining thread, the writes get handed over to the event loop
+        """
+        if self.loop is not None and not self.in_event_loop():
+            self.loop.call_soon_threadsafe(self.broadcast_peers, line, exclude, frame, key, droppable)
+            return
+        message = formatter.line_bytes(line)
+        if frame is not None:
+            message += formatter.frame_bytes(frame)
+        for name, writer in self.get_sockets():
+            if name != exclude:
+                writer.send(message, key=key, droppable=droppable)
+
+    def spawn(self, coro):
+        """Start a task on the event loop and keep hold of it until it finishes"""
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def requeue_transactions(self, transactions):
+        """Put transactions back into the mempool, except any that a block has already confirmed"""
+        with self._mempool.lock:
+            for tx in transactions:
+                if tx.txid not in self._utxo_index:
+                    self._mempool.add(tx, enforce_min_fee=False)
+
+    def chain_tip(self):
+        """Returns the length of our chain and the hash of its last block"""
+        with self._blockchain_lock:
+            return len(self._blockchain), self._blockchain.tip_hash()
+
+    def load_utxo_index(self):
+        """
+        The UTXO index from its checkpoint file, with the blocks after the checkpoint applied
+        It is built from the whole chain if there is no checkpoint or the chain no longer has the block it was saved at (a reorg)
+        """
+        index, tip_hash = utxo.UTXOIndex.load(self._utxo_index_path)
+        if index is None or index.length > len(self._blockchain) or (index.length and self._blockchain.hash_at(index.length - 1) != tip_hash):
+            index = utxo.UTXOIndex()
+        replayed = len(self._blockchain) - index.length
+        for start in range(index.length, len(self._blockchain), SYNC_BATCH_SIZE):
+            for blk in self._blockchain.blocks(start, start + SYNC_BATCH_SIZE):
+                index.apply(blk)
+        if replayed:
+            print(f"\n[Miner {self.name}] Applied {replayed} block(s) since the UTXO index's last checkpoint")
+        return index
+
+    def save_utxo_index(self):
+        """Checkpoint the UTXO index (the blockchain lock must be held so it matches the chain)"""
+        self._utxo_index.save(self._utxo_index_path, self._blockchain.tip_hash())
+
+    def append_blocks(self, blocks):
+        """Put blocks on the end of the chain and apply them to the UTXO index (the blockchain lock must be held)"""
+        for blk in blocks:
+            self._blockchain.append(blk)
+            self._utxo_index.apply(blk)
+            if self._utxo_index.length % UTXO_CHECKPOINT_INTERVAL == 0:
+                self.save_utxo_index()
+
+    def truncate_chain(self, height):
+        """Drop the blocks from height onwards and undo them in the UTXO index, returns them (the blockchain lock must be held)"""
+        dropped = self._blockchain[height:]
+        for blk in reversed(dropped):
+            self._utxo_index.undo(blk)
+        self._blockchain.truncate(height)
+        return dropped
+
+    def validate_transactions(self, txs, height=None, legacy=0):
+        """
+        The validation stage every transaction goes through before it gets into the mempool or a block with it goes on the chain
+          - its amount and fee can't be negative (a negative amount would take coins off the receiver)
+          - it can't already be confirmed in a block below height (anywhere on the chain if height is None, in a reorg
+            the blocks from height on are the ones being replaced) or be in txs more than once
+          - it has to be signed and the signature has to be good (the verifier only checks the ones it hasn't already seen),
+            except the first legacy of txs, which are from blocks mined before transactions were signed
+          - its sender has to be the address of the public key it is signed with (see signing.address),
+            so only the holder of a key can spend from its address
+        Returns whether each transaction is valid
+        Checking signatures can take a while, so a wallet's or peer's transactions (a TX line, TXBATCH or SUBMIT) are handled
+        in an executor thread rather than on the event loop
+        """
+        valid = [True] * legacy + self._verifier.verify(txs[legacy:])
+        seen = set()
+        for i, tx in enumerate(txs):
+            confirmed_at = self._utxo_index.height_of(tx.txid)
+            # Written this way round so a NaN amount or fee fails too
+            if not (tx.amount >= 0 and tx.fee >= 0) or tx.txid in seen or (confirmed_at is not None and (height is None or confirmed_at < height)):
+                valid[i] = False
+            seen.add(tx.txid)
+            if valid[i] and i >= legacy:
+                valid[i] = tx.sender == signing.address(tx.public_key)
+        return valid
+
+    def validate_blocks(self, blocks, start):
+        """
+        True if every transaction in these blocks (from height start on, following on from our chain up to start) is valid
+        The blockchain lock must be held, so the chain can't change between checking them and adding them
+        """
+        legacy = sum(len(blk.data) for blk in blocks[:max(0, self.legacy_height - start)])
+        return all(self.validate_transactions([tx for blk in blocks for tx in blk.data], start, legacy))
+
+    async def verify_off_loop(self, blocks):
+        """
+        Check the signatures in blocks from a peer in an executor thread, so a big batch doesn't hold up the event loop
+        The good ones go into the verifier's cache, so validating the blocks afterwards is just lookups
+        """
+        await self.loop.run_in_executor(None, self._verifier.verify, [tx for blk in blocks for tx in blk.data])
+
+    def confirm_transactions(self, blocks):
+        """
+        Take the transactions in these blocks out of the mempool, the UTXO index keeps them out from now on
+        It is called with the blockchain lock held, before the mining loop is woken, so it can't pick them for another block
+        """
+        with self._mempool.lock:
+            for blk in blocks:
+                self._mempool.remove([tx.txid for tx in blk.data])
+
+    def announce_block(self, height, new_block, exclude=None):
+        """
+        Tell peers about a new tip block as a compact block (header and transaction IDs only, in the frame after the line)
+        A newer tip replaces one still waiting in a peer's queue, the peer asks for any blocks it skips over
+        """
+        self.broadcast_peers(f"CMPCTBLOCK {height}", exclude=exclude, frame=new_block.compact_bytes(), key="CMPCTBLOCK")
+
+    def receive_block(self, new_block, height, peer_name, writer=None):
+        """
+        Handles a block from a peer, if it is valid and extends our tip then it goes on the chain
+        and whatever block we are mining right now is cancelled, since it would be stale
+        If the block is further ahead than our tip then we are behind, so ask that peer for the blocks we are missing
+        """
+        # A single hash check is all that is needed, the hash must be right and below the target (at no less than our minimum difficulty)
+        if not new_block.is_valid_proof(self.min_difficulty):
+            print(f"[Miner {self.name}] Rejected block from {peer_name}: invalid proof-of-work")
+            return False
+
+        with self._blockchain_lock:
+            length = len(self._blockchain)
+            tip_hash = self._blockchain.tip_hash()
+            extends_tip = height == length and new_block.previous_hash == tip_hash
+            if extends_tip:
+                if not self.validate_blocks([new_block], height):
+                    print(f"[Miner {self.name}] Rejected block from {peer_name}: invalid transaction")
+                    return False
+                self.append_blocks([new_block])
+                self.confirm_transactions([new_block])
+                # Stop mining on the old tip, the mining loop starts again with what is left in the mempool
+                self._mining_cancel.set()
+
+        if not extends_tip:
+            if height >= length and writer is not None:
+                self.request_blocks(writer, length)
+            return False
+
+        print(f"\n[Miner {self.name}] Block {new_block.hash} from {peer_name} added to the chain")
+        print(f"[Miner {self.name}] Blockchain length: {height + 1}")
+
+        # Pass it on, so miners that aren't connected to the sender get it too
+        self.announce_block(height, new_block, exclude=peer_name)
+        return True
+
+    def receive_compact_block(self, height, data, peer_name, writer):
+        """
+        Handles a compact block - the header plus transaction IDs
+        The transactions come out of our own mempool by their short IDs and we only ask the peer (GETBLOCKTXN) for the ones we don't have
+        """
+        try:
+            (timestamp, previous_hash, merkle_root, nonce, difficulty), short_ids = block.Block.read_compact(data)
+        except ValueError:
+            short_ids = []
+        # Mined blocks always have transactions (an empty one has no merkle root to check the header against)
+        if not short_ids:
+            print(f"[Miner {self.name}] Bad compact block from {peer_name}")
+            return
+        header = (height, timestamp, previous_hash, merkle_root, nonce, difficulty)
+
+        # The proof-of-work can be checked from the header alone, so don't bother with a bad block's transactions
+        block_hash = block.Block.header_hash(timestamp, merkle_root, previous_hash, nonce, difficulty)
+        if not block.Block.meets_target(block_hash, difficulty, self.min_difficulty):
+            print(f"[Miner {self.name}] Rejected block from {peer_name}: invalid proof-of-work")
+            return
+
+        # We already have it (e.g. another peer relayed it first)
+        with self._blockchain_lock:
+            if self._blockchain.height_of(block_hash) is not None:
+                return
+
+        with self._mempool.lock:
+            found = {short_id: tx for short_id in short_ids if (tx := self._mempool.get_short(short_id)) is not None}
+        missing = [short_id for short_id in short_ids if short_id not in found]
+
+        if missing:
+            self._pending_blocks[block_hash] = (header, short_ids, found)
+            formatter.write_line(writer, f"GETBLOCKTXN {block_hash} {','.join(missing)}")
+            return
+
+        self.complete_compact_block(header, short_ids, found, peer_name, writer)
+
+    def complete_compact_block(self, header, short_ids, found, peer_name, writer):
+        """Build the compact block once we have all of its transactions and handle it like any other block"""
+        height, timestamp, previous_hash, merkle_root, nonce, difficulty = header
+        new_block = block.Block([found[short_id] for short_id in short_ids], previous_hash, difficulty, timestamp=timestamp, nonce=nonce)
+
+        # If it didn't rebuild into the same block, just fall back to asking for the full block
+        if new_block.merkle_tree != merkle_root:
+            formatter.write_line(writer, f"GET_BLOCKS {height} 1")
+            return
+        self.receive_block(new_block, height, peer_name, writer)
+
+    def send_block_transactions(self, writer, block_hash, short_ids):
+        """Answer a GETBLOCKTXN with the requested transactions from one of our recent blocks"""
+        wanted = set(short_ids)
+        with self._blockchain_lock:
+            height = self._blockchain.height_of(block_hash)
+            if height is None:
+                return
+            blk = self._blockchain[height]
+        formatter.write_line(writer, f"BLOCKTXN {block_hash}")
+        formatter.write_frame(writer, transaction.Transaction.list_to_bytes([tx for tx in blk.data if tx.short_id() in wanted]))
+
+    def receive_block_transactions(self, block_hash, data, peer_name, writer):
+        """Handles the BLOCKTXN reply (the transactions are in the frame after it), fills in the missing transactions of a pending compact block"""
+        pending = self._pending_blocks.pop(block_hash, None)
+        if pending is None:
+            return
+        header, short_ids, found = pending
+        try:
+            transactions = transaction.Transaction.list_from_bytes(data)
+        except ValueError:
+            transactions = []
+        for tx in transactions:
+            found[tx.short_id()] = tx
+
+        if all(short_id in found for short_id in short_ids):
+            self.complete_compact_block(header, short_ids, found, peer_name, writer)
+        else:
+            formatter.write_line(writer, f"GET_BLOCKS {header[0]} 1")
+
+    def request_blocks(self, writer, start):
+        """Ask a peer for a batch of blocks from height start onwards"""
+        formatter.write_line(writer, f"GET_BLOCKS {max(start, 0)} {SYNC_BATCH_SIZE}")
+
+    def send_block_range(self, writer, start, count):
+        """
+        Answer a peer's GET_BLOCKS with 'BLOCKS <start> <n> <our length>' followed by a frame of n encoded blocks,
+        all written in one go rather than a block at a time, the blocks go straight from the block store's file without parsing them
+        """
+        count = max(0, min(count, SYNC_BATCH_SIZE))
+        with self._blockchain_lock:
+            length = len(self._blockchain)
+            n = max(0, min(start + count, length) - start)
+            raw_blocks = self._blockchain.raw_range(start, start + n)
+        formatter.write_line(writer, f"BLOCKS {start} {n} {length}")
+        formatter.write_frame(writer, raw_blocks)
+
+    def receive_chain(self, start, blocks, peer_length, peer_name, writer):
+        """
+        Handles a batch of blocks that a peer sent back for our GET_BLOCKS request
+        The batch goes on our chain if it links up with it and has more work after the fork than our blocks it replaces
+        (the chain with the most work wins, not the longest, a long run of easy blocks is no better than a short run of hard ones),
+        any of our blocks it replaces have their transactions put back into the mempool
+        """
+        if not blocks:
+            return
 
-    def broadcast_peers(self, line):
-        """Function will send a lines into the network for each socket's info"""
-        for _, s in self.get_sockets():
-            formatter.send_line(s, line)
+        # Every block has to have a valid proof and link to the block before it
+        for i, blk in enumerate(blocks):
+            if not blk.is_valid_proof(self.min_difficulty) or (i > 0 and blk.previous_hash != blocks[i - 1].hash):
+                print(f"[Miner {self.name}] Rejected blocks from {peer_name}: invalid chain")
+                return
 
-    def peer_reader(self, peer_name, sock):
+        replaced = []
+        with self._blockchain_lock:
+            length = len(self._blockchain)
+            if start > length:
+                linked = False
+            elif start == 0:
+                linked = blocks[0].previous_hash == "0" * 64
+            else:
+                linked = blocks[0].previous_hash == self._blockchain.hash_at(start - 1)
+
+            if linked:
+                # Skip over the blocks we already have, the fork point is the first one that is different
+                fork = start
+                while fork - start < len(blocks) and fork < length and self._blockchain.hash_at(fork) == blocks[fork - start].hash:
+                    fork += 1
+                new_blocks = blocks[fork - start:]
+
+                if new_blocks and sum(block.work(blk.difficulty) for blk in new_blocks) > self._blockchain.work(fork, length):
+                    # The transactions are checked against our chain below the fork, the blocks above it are the ones being replaced
+                    if not self.validate_blocks(new_blocks, fork):
+                        print(f"[Miner {self.name}] Rejected blocks from {peer_name}: invalid transaction")
+                        return
+                    replaced = self.truncate_chain(fork)
+                    self.append_blocks(new_blocks)
+                    self.confirm_transactions(new_blocks)
+                    self._mining_cancel.set()
+                else:
+                    new_blocks = []
+                length = len(self._blockchain)
+
+        if not linked:
+            if start == 0:
+                return
+            # We are on a fork, so step back twice as far as last time until the peer's blocks link up with ours
+            gap = max(1, 2 * (length - start))
+            self.request_blocks(writer, length - gap)
+            return
+
+        if new_blocks:
+            # Anything only in the blocks we dropped isn't confirmed any more (the UTXO index has already undone them)
+            for blk in replaced:
+                self.requeue_transactions(blk.data)
+
+            if replaced:
+                print(f"\n[Miner {self.name}] Switched to {peer_name}'s chain, replaced {len(replaced)} block(s)")
+            print(f"\n[Miner {self.name}] Synced {len(new_blocks)} block(s) from {peer_name}, blockchain length: {length}")
+            self.announce_block(length - 1, new_blocks[-1], exclude=peer_name)
+
+        # Keep going if the peer still has more
+        if new_blocks and peer_length > length:
+            self.request_blocks(writer, length)
+
+    async def peer_reader(self, peer_name, reader, writer):
         """Function to listen to messages from peers"""
         print(f"\n[Miner {self.name}] Peer connected: {peer_name}")
         try:
             while True:
-                line = formatter.receive_line(sock)
+                line = await formatter.read_line(reader)
                 if not line:
                     break
                 parts = line.split(" ", 1)
@@ -102,60 +489,127 @@ class Miner:
                     payload = parts[1]
                     
                     if cmd == "TX":
-                        self.process_transaction_message(payload, from_peer=True)
-                    elif cmd == "BLOCK":
-                        print(f"[Miner {self.name}] Received block from {peer_name}")
+                        await self.loop.run_in_executor(None, self.process_transaction_message, payload, peer_name)
+                    elif cmd in ("INV", "GETDATA"):
+                        # A frame of 32 byte transaction IDs follows
+                        frame = await formatter.read_frame(reader)
+                        if frame is None:
+                            break
+                        transaction_ids = [frame[i:i + 32] for i in range(0, len(frame) - 31, 32)]
+                        if cmd == "INV":
+                            self.receive_inventory(transaction_ids, peer_name, writer)
+                        else:
+                            self.send_requested_transactions(transaction_ids, peer_name, writer)
+                    elif cmd in ("BLOCK", "CMPCTBLOCK", "BLOCKTXN", "TXBATCH"):
+                        # These are followed by a frame with the encoded block, compact block or transactions
+                        frame = await formatter.read_frame(reader)
+                        if frame is None:
+                            break
+                        if cmd == "BLOCK":
+                            try:
+                                new_block = block.Block.from_bytes(frame)
+                            except ValueError as e:
+                                print(f"[Miner {self.name}] Bad block from {peer_name}: {e}")
+                                continue
+                            await self.verify_off_loop([new_block])
+                            self.receive_block(new_block, int(payload), peer_name, writer)
+                        elif cmd == "CMPCTBLOCK":
+                            self.receive_compact_block(int(payload), frame, peer_name, writer)
+                        elif cmd == "TXBATCH":
+                            await self.loop.run_in_executor(None, self.process_transaction_batch, frame, peer_name)
+                        else:
+                            self.receive_block_transactions(payload.strip(), frame, peer_name, writer)
+                    elif cmd == "GETBLOCKTXN":
+                        block_hash, short_ids = (payload.split(" ", 1) + [""])[:2]
+                        self.send_block_transactions(writer, block_hash, short_ids.split(","))
+                    elif cmd == "GET_BLOCKS":
+                        start, count = (payload.split() + [SYNC_BATCH_SIZE])[:2]
+                        self.send_block_range(writer, int(start), int(count))
+                        await writer.drain()
+                    elif cmd == "BLOCKS":
+                        # The encoded blocks of the batch follow straight after this header as one frame
+                        start, count, peer_length = (int(x) for x in payload.split())
+                        frame = await formatter.read_frame(reader)
+                        if frame is None:
+                            break
+                        try:
+                            blocks = block.Block.list_from_bytes(frame)
+                        except ValueError as e:
+                            print(f"[Miner {self.name}] Bad block from {peer_name}: {e}")
+                            continue
+                        if len(blocks) == count:
+                            await self.verify_off_loop(blocks)
+                            self.receive_chain(start, blocks, peer_length, peer_name, writer)
+        except (ConnectionError, ValueError):
+            pass
         finally:
             print(f"\n[Miner {self.name}] Peer disconnect: {peer_name}")
-            self.remove_peer(peer_name)
+            self.remove_peer(peer_name, writer)
 
-    def process_local_message(self, text, client_socket):
+    def process_local_message(self, text, writer):
         """Function to handle the processing of text, that the Miner uses to broadcast a new peer into the network (P2P network)"""
         print(f"[Miner {self.name}] from client: {text}")
-        formatter.send_line(client_socket, f"[you@{self.name}] {text}")
+        formatter.write_line(writer, f"[you@{self.name}] {text}")
         self.broadcast_peers(f"MSG {self.name} {text}")
 
-    def process_transaction_message(self, message, from_peer=False):
-        """Handles whether a transaction is from a wallet or a peer"""
+    def max_transaction_size(self):
+        """
+        The biggest a transaction can be to get into the mempool - one that could never fit in a block would just sit there
+        (a block of one transaction takes a byte for the count as well)
+        """
+        return self.max_block_bytes - 1
+
+    def process_transaction_message(self, message, peer_name=None):
+        """
+        Handles whether a transaction is from a wallet or a peer (peer_name is the peer it came from)
+        Returns True if the miner has the transaction now (it was added, or it was already in the mempool or a block),
+        False for anything that wasn't taken
+        """
         try:
             if message.startswith("Transaction:"):
                 transaction_data = message.replace("Transaction:", "")
                 # Machine readable
                 transaction_data = transaction_data.strip().split(",") 
 
-                if len(transaction_data) >= 5:
+                # Transaction: sender, receiver, amount, fee, ID, timestamp, public key, signature
+                if len(transaction_data) >= 8:
                     sender = transaction_data[0].strip()
                     receiver = transaction_data[1].strip()
-                    amount = float(transaction_data[2].strip())
-                    fee = float(transaction_data[3].strip())
                     transaction_id = transaction_data[4].strip()
+                    txid = bytes.fromhex(transaction_id)
 
-                    with self._mempool_lock:
-                        # Check duplicate transaction
-                        if transaction_id in self._transaction_ids:
+                    with self._mempool.lock:
+                        # Check duplicate transaction (or one that is already in a block, or was evicted for too low a fee)
+                        if txid in self._mempool or txid in self._utxo_index or self._mempool.was_evicted(txid):
                             return True
-                        
-                        # Else will now make the transaction
-                        tx = transaction.Transaction(sender, receiver, amount, fee)
 
-                        # This is the sequence thing if there is two transaction fees with the same value
-                        with self._seq_lock:
-                            seq = self._mempool_seq
-                            self._mempool_seq += 1
-
-                        self._mempool.put((-float(fee), seq, tx))  # As requested, done highest fee as highest priority
-                        self._transaction_ids.add(transaction_id)
+                    # Else will now make the transaction, with the wallet's own timestamp so it keeps the ID the wallet gave it
+                    # (a line whose ID doesn't match what it says raises ValueError)
+                    tx = transaction.Transaction.from_fields(sender, receiver, *transaction_data[2:4], transaction_data[5], transaction_id, *transaction_data[6:8])
+                    if tx.size() > self.max_transaction_size():
+                        print(f"[Miner {self.name}] Rejected transaction {transaction_id}: too big for a block")
+                        return False
+                    # The signature is checked outside the mempool lock, so the mining thread isn't kept waiting on it
+                    if not self.validate_transactions([tx])[0]:
+                        print(f"[Miner {self.name}] Rejected transaction {transaction_id}: it failed validation")
+                        return False
+
+                    with self._mempool.lock:
+                        # As requested, done highest fee as highest priority
+                        # If it is under the minimum fee rate (or the mempool is full of better ones) it is dropped and not gossiped
+                        if not self._mempool.add(tx):
+                            print(f"[Miner {self.name}] Rejected transaction {transaction_id}: its fee rate is too low for the mempool")
+                            return False
 
                         print(f"\n[Miner {self.name}] Transaction was added to the mempool:")
                         print(f"\tID: {transaction_id}")
                         print(f"\tSender: {sender}")
                         print(f"\tReceiver: {receiver}")
-                        print(f"\tAmount: {amount}")
-                        print(f"\tFee: {fee}")
+                        print(f"\tAmount: {tx.amount}")
+                        print(f"\tFee: {tx.fee}")
 
-                        # If it came from a wallet and not a peer then I have to broadcast it to the network
-                        if not from_peer:
-                            self.broadcast_peers(f"TX {message}") # Its not the most efficient way I wrote the strings
+                        # Queue it to be announced to the rest of the network (the gossip sender does the writing)
+                        self._gossip.queue([tx.txid], exclude=peer_name)
                         return True
             return False
         
@@ -163,90 +617,218 @@ class Miner:
             print(f"[Miner {self.name}] Error: {e}")
             return False
 
-    def send_blockchain_data(self, conn, start_index):
+    def process_transaction_batch(self, data, peer_name=None):
+        """
+        Handles a batch of encoded transactions (a wallet's SUBMIT or a peer's TXBATCH), returns a result for each one
+        The batch goes through the validation stage together (the signatures are checked as one batch),
+        then the valid ones go into the mempool with its lock taken once and the batch gets one line printed for it,
+        and the accepted ones are queued to be announced to the other peers
+        """
+        try:
+            txs = transaction.Transaction.list_from_bytes(data)
+        except ValueError as e:
+            print(f"[Miner {self.name}] Bad transaction batch: {e}")
+            return []
+
+        # One already in a block or earlier in the batch isn't validated again, add_batch counts it as a duplicate
+        # (not rejected, so a wallet sending a batch again isn't refunded for ones that did go through)
+        fresh = {}
+        for tx in txs:
+            if tx.txid not in self._utxo_index:
+                fresh.setdefault(tx.txid, tx)
+        fresh = list(fresh.values())
+        good = {tx.txid for tx, ok in zip(fresh, self.validate_transactions(fresh)) if ok}
+        valid = [tx.txid in good or tx.txid in self._utxo_index for tx in txs]
+        added = iter(self._mempool.add_batch([tx for tx, ok in zip(txs, valid) if ok], confirmed=self._utxo_index, max_size=self.max_transaction_size()))
+        results = [next(added) if ok else mempool.REJECTED for ok in valid]
+        accepted = [tx for tx, result in zip(txs, results) if result == mempool.ACCEPTED]
+        print(f"\n[Miner {self.name}] Batch of {len(txs)} transaction(s): {len(accepted)} added to the mempool, "
+              f"{results.count(mempool.DUPLICATE)} duplicate(s), {results.count(mempool.REJECTED)} rejected ({valid.count(False)} invalid)")
+
+        if peer_name is not None:
+            self._gossip.mark_known(peer_name, [tx.txid for tx in txs])
+            self._gossip.received([tx.txid for tx in txs])
+        self._gossip.queue([tx.txid for tx in accepted], exclude=peer_name)
+        return results
+
+    def receive_inventory(self, transaction_ids, peer_name, writer):
+        """Handles a peer's INV, asks it (GETDATA) for the transactions we haven't seen and aren't already fetching"""
+        self._gossip.mark_known(peer_name, transaction_ids)
+        with self._mempool.lock:
+            unseen = [txid for txid in transaction_ids
+                      if txid not in self._mempool and txid not in self._utxo_index and not self._mempool.was_evicted(txid)]
+        wanted = self._gossip.request(unseen)
+        if wanted:
+            formatter.write_line(writer, f"GETDATA {len(wanted)}")
+            formatter.write_frame(writer, b"".join(wanted))
+
+    def send_requested_transactions(self, transaction_ids, peer_name, writer):
+        """Answer a peer's GETDATA with the transactions we still have in the mempool, as one TXBATCH"""
+        with self._mempool.lock:
+            txs = [tx for tx in map(self._mempool.get, transaction_ids) if tx is not None]
+        if txs:
+            self._gossip.mark_known(peer_name, [tx.txid for tx in txs])
+            formatter.write_line(writer, f"TXBATCH {len(txs)}")
+            formatter.write_frame(writer, transaction.Transaction.list_to_bytes(txs))
+
+    async def gossip_sender(self):
+        """
+        Every GOSSIP_INTERVAL, announce the transactions queued for each peer as INVs of up to MAX_INV_SIZE IDs
+        An INV can be dropped if the peer falls behind, it will still get the transactions in blocks
+        """
+        while self.running:
+            await asyncio.sleep(gossip.GOSSIP_INTERVAL)
+            peers = dict(self.get_sockets())
+            for name, transaction_ids in self._gossip.take_pending().items():
+                writer = peers.get(name)
+                if writer is None or writer.is_closing():
+                    continue
+                for i in range(0, len(transaction_ids), gossip.MAX_INV_SIZE):
+                    chunk = transaction_ids[i:i + gossip.MAX_INV_SIZE]
+                    writer.send(formatter.line_bytes(f"INV {len(chunk)}") + formatter.frame_bytes(b"".join(chunk)), droppable=True)
+
+    def blockchain_data(self, start_index, count):
         """
-        Send blockchain blocks to wallet starting from start_index
-        This connection will close after sending data, so thats its constantly refreshing new info
+        The reply to a wallet's GET_BLOCKS - up to count blocks (at most SYNC_BATCH_SIZE) from start_index onwards,
+        as one frame of encoded blocks read straight off disk (an empty frame once the wallet has reached our tip)
+        The wallet asks again from where it got to, so a long chain is never read into one frame
         """
+        start_index = max(start_index, 0)
+        count = max(0, min(count, SYNC_BATCH_SIZE))
         try:
             with self._blockchain_lock:
-                # Get blocks from start_index onwards
-                if start_index < 0:
-                    start_index = 0
-                
-                blocks_to_send = self._blockchain[start_index:] if start_index < len(self._blockchain) else []
-            
-            if not blocks_to_send:
-                # No new blocks, just send END
-                formatter.send_line(conn, "END_BLOCKS")
-                return
-            
-            # Send each block
-            for i, blk in enumerate(blocks_to_send, start=start_index):
-                formatter.send_line(conn, f"BLOCK {i} {len(blk.data)}")
-                
-                # Send each transaction in the block
-                for tx in blk.data:
-                    tx_str = f"TX: {tx.sender},{tx.receiver},{tx.amount},{tx.fee},{tx.transaction_id}"
-                    formatter.send_line(conn, tx_str)
-            
-            # Signal end of blocks
-            formatter.send_line(conn, "END_BLOCKS")
-            
+                return self._blockchain.raw_range(start_index, start_index + count)
         except Exception as e:
             print(f"[Miner {self.name}] Error sending blockchain: {e}")
-            try:
-                formatter.send_line(conn, "END_BLOCKS")
-            except:
-                pass
+            return b""
+
+    def send_headers(self, writer, start_index, count):
+        """
+        Answer a wallet's GET_HEADERS - one frame of up to count fixed-size block headers from start_index onwards,
+        read off the front of each block on disk (fewer than asked for means the wallet has reached our tip)
+        """
+        count = max(0, min(count, HEADERS_BATCH_SIZE))
+        with self._blockchain_lock:
+            headers = self._blockchain.headers(start_index, start_index + count)
+        formatter.write_frame(writer, headers)
+
+    def owner_transactions(self, owner, start_index):
+        """
+        The reply to a light wallet's GET_TXS - only the transactions paying the owner from start_index onwards, each with a
+        merkle inclusion proof, along with the headers of the blocks they are in so the wallet can check the proofs itself
+        At most OWNER_SCAN_LIMIT blocks are looked through, read SYNC_BATCH_SIZE at a time, so a wallet that is far behind
+        doesn't have the whole chain loaded for it in one go
+        The frame is the version, the height it was looked through up to (not including), the number of blocks,
+        then for each block its header, height, and number of transactions, each transaction followed by its proof
+        """
+        start_index = max(start_index, 0)
+        with self._blockchain_lock:
+            stop = min(start_index + OWNER_SCAN_LIMIT, len(self._blockchain))
+
+        matched = []
+        for batch_start in range(start_index, stop, SYNC_BATCH_SIZE):
+            with self._blockchain_lock:
+                blocks = self._blockchain.blocks(batch_start, min(batch_start + SYNC_BATCH_SIZE, stop))
+            for height, blk in enumerate(blocks, start=batch_start):
+                indexes = [i for i, tx in enumerate(blk.data) if tx.receiver == owner]
+                if indexes:
+                    # The proofs are made now, so only the matching transactions are kept hold of and not their blocks
+                    matched.append((height, blk.header_bytes(), [(blk.data[i], i, proof) for i, proof in zip(indexes, blk.merkle_proofs(indexes))]))
+
+        out = bytearray([encoding.VERSION])
+        encoding.write_varint(out, stop)
+        encoding.write_varint(out, len(matched))
+        for height, header, proofs in matched:
+            out += header
+            encoding.write_varint(out, height)
+            encoding.write_varint(out, len(proofs))
+            for tx, i, path in proofs:
+                tx.write(out)
+                merkle.write_proof(out, i, path)
+        return bytes(out)
+
+    def send_balance(self, writer, owner):
+        """Answer a BALANCE query straight from the UTXO index, the reply is BALANCE <owner> <balance> <chain length>"""
+        with self._blockchain_lock:
+            balance = self._utxo_index.balance(owner)
+            length = self._utxo_index.length
+        formatter.write_line(writer, f"BALANCE {owner} {balance} {length}")
+
+    async def answer_query(self, line, writer):
+        """
+        Answer a wallet's query (GET_BLOCKS <start> <count>, GET_HEADERS <start> <count>, GET_TXS <owner> <start> or BALANCE <owner>),
+        returns False if the line isn't one
+        GET_BLOCKS and GET_TXS read blocks off disk (and GET_TXS makes merkle proofs), so they are answered off the event loop
+        """
+        parts = line.split()
+        if line.startswith("GET_BLOCKS"):
+            start_index = int(parts[1]) if len(parts) > 1 else 0
+            count = int(parts[2]) if len(parts) > 2 else SYNC_BATCH_SIZE
+            formatter.write_frame(writer, await self.loop.run_in_executor(None, self.blockchain_data, start_index, count))
+        elif line.startswith("GET_HEADERS"):
+            start_index = int(parts[1]) if len(parts) > 1 else 0
+            count = int(parts[2]) if len(parts) > 2 else HEADERS_BATCH_SIZE
+            self.send_headers(writer, start_index, count)
+        elif line.startswith("GET_TXS") and len(parts) >= 2:
+            start_index = int(parts[2]) if len(parts) > 2 else 0
+            formatter.write_frame(writer, await self.loop.run_in_executor(None, self.owner_transactions, parts[1], start_index))
+        elif line.startswith("BALANCE") and len(parts) == 2:
+            self.send_balance(writer, parts[1])
+        else:
+            return False
+        await writer.drain()
+        return True
 
-    def handle_client(self, connection, address, first_line=None):
+    async def handle_wallet_line(self, line, reader, writer):
+        """
+        One line from a wallet - a blockchain query, a batch of transactions or a single transaction
+        A batch is SUBMIT <n> followed by a frame of n encoded transactions, answered with RESULTS <n> and a frame of one result byte each
+        """
+        # Check if this is a blockchain query, the connection stays open for the wallet's next query (e.g. GET_TXS after GET_HEADERS)
+        if await self.answer_query(line, writer):
+            return
+
+        if line.startswith("SUBMIT"):
+            frame = await formatter.read_frame(reader)
+            if frame is None:
+                raise ConnectionError("wallet closed the connection")
+            results = await self.loop.run_in_executor(None, self.process_transaction_batch, frame)
+            formatter.write_line(writer, f"RESULTS {len(results)}")
+            formatter.write_frame(writer, bytes(results))
+            await writer.drain()
+
+        # Otherwise process as transaction
+        # OK if the miner has it now (it was added, or it already had it), otherwise REJECTED
+        elif await self.loop.run_in_executor(None, self.process_transaction_message, line):
+            formatter.write_line(writer, "OK")
+        else:
+            formatter.write_line(writer, "REJECTED")
+
+    async def handle_client(self, reader, writer, first_line=None):
         """Function to handle when a wallet connects to a miner"""
         try:
             if first_line:
-                # Check if this is a blockchain query
-                if first_line.startswith("GET_BLOCKS"):
-                    parts = first_line.split()
-                    start_index = int(parts[1]) if len(parts) > 1 else 0
-                    # Send blockchain data and close that connection
-                    self.send_blockchain_data(connection, start_index)
-                    return
-                
-                # Otherwise process as transaction
-                if self.process_transaction_message(first_line):
-                    formatter.send_line(connection, "OK")
+                await self.handle_wallet_line(first_line, reader, writer)
 
             # Keep connection open for persistent transaction sending
             while True:
-                line = formatter.receive_line(connection)
+                line = await formatter.read_line(reader)
                 if not line or line.strip().lower() == "exit":
                     break
-                
-                # Now handle GET_BLOCKS in the loop
-                if line.startswith("GET_BLOCKS"):
-                    parts = line.split()
-                    start_index = int(parts[1]) if len(parts) > 1 else 0
-                    self.send_blockchain_data(connection, start_index)
-                    continue
-                
-                if self.process_transaction_message(line):
-                    formatter.send_line(connection, "OK")
+                await self.handle_wallet_line(line, reader, writer)
+        except (ConnectionError, ValueError):
+            pass
         finally:
-            try:
-                connection.close()
-            except:
-                pass
-            
-
-    def classify_and_handle(self, conn, addr):
-        """Function to handle a new connection - whether they are a peer or other"""
+            writer.close()
+
+    async def classify_and_handle(self, reader, writer):
+        """Function to handle a new connection - whether they are a peer or other (this is the listener's callback)"""
         # This is the first line received from the new connection
-        first_line = formatter.receive_line(conn)
+        first_line = await formatter.read_line(reader)
         
         # Close connection if nothing
         if not first_line:
-            try: conn.close()
-            except: pass
+            writer.close()
             return
         
         parts = first_line.split()
@@ -254,199 +836,188 @@ class Miner:
         if len(parts) == 2 and parts[0].upper() == "PEER":
             pname = parts[1]
             # Add the peer to list of known peers/miners (self._miners)
-            self.add_peer(pname, conn)
-            self.peer_reader(pname, conn)
+            writer = self.add_peer(pname, writer)
+            # Catch up with anything the peer has that we don't
+            self.request_blocks(writer, self.chain_tip()[0])
+            await self.peer_reader(pname, reader, writer)
         else:
-            self.handle_client(conn, addr, first_line=first_line)
+            await self.handle_client(reader, writer, first_line=first_line)
 
-    def connect_to_peer(self, peer_host, peer_port, peer_name):
+    async def connect_to_peer(self, peer_host, peer_port, peer_name):
         """Function used to connect Miner to peer"""
         # If the name is my name (the miner) or the name is already a connected peer, then we don't need to connect
         if peer_name == self.name or peer_name in self.peer_names():
             return
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.connect((peer_host, peer_port))
-            formatter.send_line(s, f"PEER {self.name}")
-            self.add_peer(peer_name, s)
-            threading.Thread(target=self.peer_reader, args=(peer_name, s), daemon=True).start()
-        except Exception:
-            pass
-
-    def start_peer_acceptance_loop(self):
-        """This triggers the Miner to start listening for other Miners on the network (peers)"""
-        try:
-            # When the Miner is running
-            while self.running:
-                try:
-                    # Get the connection and address to the Bootstrap node
-                    connection, address = self.listener.accept()
-                    threading.Thread(target=self.classify_and_handle, args=(connection, address), daemon=True).start()
-                except OSError:
-                    # Close the socket
-                    break
-                except Exception:
-                    # Ignore errors
-                    if not self.running:
-                        break
-        except Exception:
-            pass
+            reader, writer = await asyncio.open_connection(peer_host, peer_port, limit=formatter.STREAM_LIMIT)
+        except OSError:
+            return
+        formatter.write_line(writer, f"PEER {self.name}")
+        writer = self.add_peer(peer_name, writer)
+        self.request_blocks(writer, self.chain_tip()[0])
+        self.spawn(self.peer_reader(peer_name, reader, writer))
 
     def start_mining_loop(self):
         """This triggers the Miner to start mining"""
         print(f"\n[Miner {self.name}] Starting to mine")
 
         try:
-            # I need to check the mempool periodically, so I will do it every 2 seconds
+            # The mempool wakes this up when transactions arrive, so there is no polling
             while self.running:
-                # Check every 2s
-                time.sleep(2)
+                # Wait for the first transaction (waking up every second to see if the miner has stopped),
+                # then for enough of them for a block, but only up to block_timeout before mining what there is
+                if not self._mempool.wait_until(1, 1.0):
+                    continue
+                self._mempool.wait_until(self.min_trans, self.block_timeout)
 
-                selected_transactions = []
+                # Take the highest fee transactions that fit in a block, they stay in the mempool until a block confirms them
+                selected_transactions = self._mempool.select(self.max_block_bytes)
 
-                # This is my way that I got the transactions out of the priority queue
-                with self._mempool_lock:
-                    if self._mempool.qsize() >= self.min_trans:
-                        for i in range(self.min_trans):
-                            try:
-                                priority, seq, tx = self._mempool.get_nowait()
-                                selected_transactions.append(tx)
-                                self._mempool.task_done()
-                                # This is where I want to check for duplicates from before
-                                self._transaction_ids.discard(tx.transaction_id) # I could have done .remove() but .discard() gives no error
-                            except queue.Empty:
-                                break
-
-                        # If there wasn't enough transactions for the block
-                        if len(selected_transactions) < self.min_trans:
-                            for tx in selected_transactions:
-                                with self._seq_lock:
-                                    seq = self._mempool_seq
-                                    self._mempool_seq += 1
-                                self._mempool.put((-tx.fee, seq, tx))
-                                self._transaction_ids.add(tx.transaction_id)
-                            selected_transactions = []
-
-                if len(selected_transactions) == self.min_trans:
+                # They were all validated on the way into the mempool (so this is just cache lookups), but they are checked again
+                # against the chain as it is now, under the same lock as the tip and a fresh cancel event are taken -
+                # a peer's block confirming one can't land in between without it being caught here or cancelling this block
+                # (the same goes for the miner stopping, run_miner sets running and the cancel event under this lock too)
+                with self._blockchain_lock:
+                    if not self.running:
+                        break
+                    valid = self.validate_transactions(selected_transactions)
+                    if not all(valid):
+                        with self._mempool.lock:
+                            self._mempool.remove([tx.txid for tx, ok in zip(selected_transactions, valid) if not ok])
+                        selected_transactions = [tx for tx, ok in zip(selected_transactions, valid) if ok]
+                    previous_hash = self._blockchain.tip_hash()
+                    cancel = threading.Event()
+                    self._mining_cancel = cancel
+
+                if selected_transactions:
                     print(f"\n[Miner {self.name}] Mining block with {len(selected_transactions)} transactions")
 
-                    # Get the previous blocks hash
-                    with self._blockchain_lock:
-                        if self._blockchain:
-                            previous_hash = self._blockchain[-1].hash
-                        else:
-                            previous_hash = "0" * 64 
-
                     try:
-                        new_block = block.Block(selected_transactions, previous_hash, self.difficulty)
+                        new_block = block.Block(selected_transactions, previous_hash, self.difficulty, self.mining_engine, cancel)
 
-                        # Now just add the block to the chain
+                        # Now just add the block to the chain, unless a peer's block took the tip while we were finishing
                         with self._blockchain_lock:
-                            self._blockchain.append(new_block)
+                            tip_hash = self._blockchain.tip_hash()
+                            if tip_hash != previous_hash:
+                                raise mining.MiningInterrupted("the chain tip moved on")
+                            self.append_blocks([new_block])
+                            self.confirm_transactions([new_block])
+                            height = len(self._blockchain) - 1
 
                         print(f"\n[Miner {self.name}] Block mined! Hash: {new_block.hash}")
-                        print(f"[Miner {self.name}] Blockchain length: {len(self._blockchain)}")
+                        print(f"[Miner {self.name}] {new_block.mining_attempts} attempts in {new_block.mining_time:.2f}s")
+                        print(f"[Miner {self.name}] Blockchain length: {height + 1}")
 
-                        # Tell the network via broadcast of block
-                        self.broadcast_peers(f"BLOCK {new_block.hash}")
+                        # Tell the network via broadcast of the block, peers rebuild it from the transactions they already have
+                        self.announce_block(height, new_block)
+
+                    except mining.MiningInterrupted:
+                        # A peer beat us to it, so start again on the new tip with whatever is still unconfirmed in the mempool
+                        print(f"\n[Miner {self.name}] Stopped mining, a peer's block extended the chain first")
 
                     except Exception as e:
                         print(f"[Miner {self.name}] Error creating block: {e}")
-                        
-                        for tx in selected_transactions:
-                            with self._seq_lock:
-                                seq = self._mempool_seq
-                                self._mempool_seq += 1
-                            with self._mempool_lock:
-                                self._mempool.put((-tx.fee, seq, tx))
-                                self._transaction_ids.add(tx.transaction_id)
         except Exception:
             pass
                 
-    def peer_connector(self):
-        """This triggers the Miner to request the Miner list from the Bootstrap node and connects to each peer (other Miners)"""
-        try:
-            while self.running:
-                try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.connect((self.bootstrap_host, self.bootstrap_port))
-                        formatter.send_line(s, "LIST")
-                        entries = []
-                        while True:
-                            line = formatter.receive_line(s)
-                            if not line or line == "END":
-                                break
-                            parts = line.split()
-                            if len(parts) == 3:
-                                name, host, port = parts[0], parts[1], int(parts[2])
-                                entries.append((name, host, port))
-                    for name, host, port in entries:
-                        self.connect_to_peer(host, port, name)
-                except Exception:
-                    if not self.running:
+    async def peer_connector(self):
+        """
+        This registers the Miner with the Bootstrap node and subscribes to membership changes on that same connection,
+        the Bootstrap node pushes a JOIN for every miner on the network and then a JOIN/LEAVE whenever one registers or leaves,
+        so peers (other Miners) are connected to straight away instead of polling LIST
+        It only goes round the loop again if the connection to the Bootstrap node drops, to register again
+        """
+        while self.running:
+            reader = await self.register_with_bootstrap()
+            if reader is not None:
+                formatter.write_line(self.bootstrap_writer, "SUBSCRIBE")
+                while True:
+                    line = await formatter.read_line(reader)
+                    if not line:
                         break
-                time.sleep(1.5)
-        except Exception:
-            pass
-    
-    def start_miner(self):
-        """This function starts the miner - accepting connections from network peers and mining"""
-        # First I see Dimi makes a socket for the miner, in which is a 'listener' socket
-        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.listener.bind((self.host, self.port))
-        self.listener.listen()
-
-        print(f"\n[Miner {self.name}] Serving on {self.host}:{self.port}")
-
-        # Then register the newly made miner
-        self.bootstrap_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    parts = line.split()
+                    if len(parts) != 4:
+                        continue
+                    command, name, host, port = parts
+                    if command == "JOIN" and port.isdigit():
+                        self.spawn(self.connect_to_peer(host, int(port), name))
+                    elif command == "LEAVE":
+                        # A miner dropping its bootstrap registration doesn't mean our connection to it has gone (it may
+                        # have re-registered and reconnected already), peer_reader removes the peer once its connection fails,
+                        # so only a connection that is already closing is dropped here (and only that one, not a newer one)
+                        writer = dict(self.get_sockets()).get(name)
+                        if writer is not None and writer.is_closing():
+                            self.remove_peer(name, writer)
+
+                print(f"\n[Miner {self.name}] Lost the connection to the Bootstrap node")
+                self.bootstrap_writer.close()
+                self.bootstrap_writer = None
+            await asyncio.sleep(1.5)
+
+    async def register_with_bootstrap(self):
+        """
+        Register the miner with the bootstrap node, the connection stays open for as long as the miner is registered
+        Returns the connection's reader, or None if it didn't work
+        """
         try:
-            self.bootstrap_socket.connect((self.bootstrap_host, self.bootstrap_port))
-            formatter.send_line(self.bootstrap_socket, f"REGISTER {self.name} {self.host} {self.port}")
-            if formatter.receive_line(self.bootstrap_socket) != "OK":
+            reader, writer = await asyncio.open_connection(self.bootstrap_host, self.bootstrap_port)
+            formatter.write_line(writer, f"REGISTER {self.name} {self.host} {self.port}")
+            if await formatter.read_line(reader) != "OK":
                 print(f"\n[Miner {self.name}] Bootstrap node registration failed")
-                self.bootstrap_socket.close()
-                self.bootstrap_socket = None
-            else:
-                print(f"\n[Miner {self.name}] Registered with Bootstrap node")
-        except Exception as e:
+                writer.close()
+                return None
+            print(f"\n[Miner {self.name}] Registered with Bootstrap node")
+            self.bootstrap_writer = writer
+            return reader
+        except OSError as e:
             print(f"\n[Miner {self.name}] Could not register with Bootstrap node: {e}")
-            self.bootstrap_socket = None
+            return None
 
-        # Now the Miner is connected up and running
-        self.running = True
+    async def run_miner(self):
+        """The miner's main coroutine - accepting connections from network peers and mining"""
+        self.loop = asyncio.get_running_loop()
 
-        # Now we create a threads to handle each of the Miner's tasks
-        #   1 - Periodically get all miners on network and connect to them
-        threading.Thread(target=self.peer_connector, daemon=True).start()
-        #   2 - Start accepting incoming peer connections
-        threading.Thread(target=self.start_peer_acceptance_loop, daemon=True).start()
-        #   3 - Start mining
-        threading.Thread(target=self.start_mining_loop, daemon=True).start()
+        # First I see Dimi makes a socket for the miner, in which is a 'listener' socket (here it is an asyncio server)
+        self.listener = await asyncio.start_server(self.classify_and_handle, self.host, self.port, limit=formatter.STREAM_LIMIT, reuse_address=True)
 
-        # Periodically check the miner is still running
+        print(f"\n[Miner {self.name}] Serving on {self.host}:{self.port}")
+
+        # Now the Miner is up and running
+        self.running = True
+
+        # The listener is already accepting connections, so now
+        #   1 - Start mining, off the event loop in an executor thread, and the transaction gossip sender
+        self.loop.run_in_executor(None, self.start_mining_loop)
+        self.spawn(self.gossip_sender())
+        #   2 - Register with the bootstrap node and connect to the miners it tells us about
         try:
-            while self.running == True:
-                time.sleep(3600)
-        except KeyboardInterrupt:
-            print(f"\n[Miner {self.name}] Miner is stopping")
+            await self.peer_connector()
         finally:
-            self.running = False
+            # Don't leave the executor waiting on a block that is halfway mined, under the blockchain lock
+            # so the mining loop can't swap in a fresh cancel event after this one is set and carry on mining
+            with self._blockchain_lock:
+                self.running = False
+                self._mining_cancel.set()
 
-            if self.listener:
-                try: self.listener.close()
-                except: pass
+            self.listener.close()
 
-            if self.bootstrap_socket:
-                try: self.bootstrap_socket.close()
-                except: pass
+            if self.bootstrap_writer:
+                self.bootstrap_writer.close()
 
             with self._peers_lock:
-                for peer_socket in self._peers.values():
-                    try:
-                        peer_socket.close()
-                    except:
-                        pass
-                self._peers.clear()
\ No newline at end of file
+                for writer in self._peers.values():
+                    writer.close()
+                self._peers.clear()
+
+    def start_miner(self):
+        """This function starts the miner, it runs the event loop until the miner is stopped"""
+        try:
+            asyncio.run(self.run_miner())
+        except KeyboardInterrupt:
+            print(f"\n[Miner {self.name}] Miner is stopping")
+        finally:
+            # The mining thread has finished by now, so nothing else is writing to the chain
+            with self._blockchain_lock:
+                self.save_utxo_index()
+            self._blockchain.close()
+            self._verifier.close()
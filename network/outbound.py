@@ -0,0 +1,127 @@
+import asyncio
+from collections import deque
+
+# The most messages and bytes that can be waiting to go to one peer
+MAX_QUEUE_MESSAGES = 10000
+MAX_QUEUE_BYTES = 16 * 1024 * 1024
+# Messages are written to the socket until this much is buffered in it, then the writer task waits for it to drain
+HIGH_WATER_BYTES = 256 * 1024
+# A peer that hasn't taken anything off its socket for this many seconds is disconnected
+STALL_TIMEOUT = 30.0
+
+class PeerWriter:
+    """
+    The outbound queue for one peer, with its own writer task that sends what is queued as fast as the peer takes it
+    It stands in for the peer's StreamWriter (write, drain, close, is_closing), so formatter.write_line and write_frame work on it
+    Whole messages are queued, so a line and its frame are never split up
+      - a message with a coalesce key replaces the one with the same key that is still waiting (e.g. only the newest tip announcement matters)
+      - when the queue goes over MAX_QUEUE_MESSAGES or MAX_QUEUE_BYTES the oldest droppable messages (announcements) are dropped,
+        and if that still isn't enough the peer has fallen too far behind and is disconnected
+      - a peer that doesn't drain its socket for STALL_TIMEOUT seconds is disconnected
+    It is only used from the event loop (broadcast_peers hands writes over from the mining thread)
+    """
+    def __init__(self, owner, name, writer):
+        self.owner = owner
+        self.name = name
+        self._writer = writer
+        # [key, data, droppable], oldest first, and coalesce key -> its entry while it is still waiting
+        self._queue = deque()
+        self._keyed = {}
+        self.queued_bytes = 0
+        self.dropped = 0
+
+        self._ready = asyncio.Event()
+        self._empty = asyncio.Event()
+        self._empty.set()
+        self._task = asyncio.ensure_future(self._run())
+
+    def is_closing(self):
+        return self._writer.is_closing()
+
+    def close(self):
+        self._writer.close()
+        self._ready.set()
+
+    def abort(self):
+        """Drop the connection straight away, a plain close would wait for the peer to read what is already buffered"""
+        self._writer.transport.abort()
+        self.close()
+
+    def write(self, data):
+        """Queue bytes like a StreamWriter would (never dropped or coalesced)"""
+        self.send(data)
+
+    async def drain(self):
+        """Wait until everything queued has been handed to the socket"""
+        await self._empty.wait()
+
+    def send(self, data, key=None, droppable=False):
+        """Queue a whole message, see the class docstring for what key and droppable do"""
+        if self.is_closing():
+            return
+        data = bytes(data)
+        entry = self._keyed.get(key) if key is not None else None
+        if entry is not None:
+            self.queued_bytes += len(data) - len(entry[1])
+            entry[1] = data
+            return
+
+        entry = [key, data, droppable]
+        self._queue.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        self.queued_bytes += len(data)
+        self._empty.clear()
+        self._ready.set()
+
+        if self._over_limit():
+            self._shed()
+
+    def _over_limit(self):
+        return len(self._queue) > MAX_QUEUE_MESSAGES or self.queued_bytes > MAX_QUEUE_BYTES
+
+    def _shed(self):
+        """Drop droppable messages, oldest first, until the queue is back under its limits, or disconnect the peer"""
+        kept = deque()
+        while self._queue:
+            entry = self._queue.popleft()
+            if entry[2] and self._over_limit():
+                self._forget(entry)
+                self.dropped += 1
+            else:
+                kept.append(entry)
+        self._queue = kept
+        if self._over_limit():
+            print(f"[Miner {self.owner}] Disconnecting {self.name}: it has fallen too far behind ({len(self._queue)} messages, {self.queued_bytes} bytes queued)")
+            self.abort()
+
+    def _forget(self, entry):
+        self.queued_bytes -= len(entry[1])
+        if entry[0] is not None and self._keyed.get(entry[0]) is entry:
+            del self._keyed[entry[0]]
+
+    async def _run(self):
+        """The writer task, it hands messages to the socket and waits for it to drain whenever too much is buffered"""
+        try:
+            while not self._writer.is_closing():
+                await self._ready.wait()
+                self._ready.clear()
+                while self._queue and not self._writer.is_closing():
+                    entry = self._queue.popleft()
+                    self._forget(entry)
+                    self._writer.write(entry[1])
+                    if self._writer.transport.get_write_buffer_size() > HIGH_WATER_BYTES:
+                        await asyncio.wait_for(self._writer.drain(), STALL_TIMEOUT)
+                if not self._queue:
+                    self._empty.set()
+        except asyncio.TimeoutError:
+            print(f"[Miner {self.owner}] Disconnecting {self.name}: it stopped reading for {STALL_TIMEOUT:.0f}s")
+            self._writer.transport.abort()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._writer.close()
+            self._queue.clear()
+            self._keyed.clear()
+            self.queued_bytes = 0
+            self._empty.set()
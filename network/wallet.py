@@ -1,15 +1,35 @@
+from core import block
+from core import encoding
+from core import headerchain
+from core import mempool
+from core import merkle
+from core import signing
 from core import transaction
+from core import utxo
 from utils import formatter
+import os
 import random
 import time
 import socket
 import threading
 
+# The most headers asked for in one GET_HEADERS request (the miner caps it at its own HEADERS_BATCH_SIZE)
+HEADERS_BATCH = 2000
+# The most blocks asked for in one GET_BLOCKS request by a full wallet (the miner caps it at its own SYNC_BATCH_SIZE)
+BLOCKS_BATCH = 500
+# The lowest difficulty a header can have for a light wallet to take it, the network's (main.py's miners mine at 2)
+MIN_DIFFICULTY = 2
+
 class Wallet:
-    def __init__(self, owner: str):
+    def __init__(self, owner: str, light_client: bool = True, key_file: str | None = None, min_difficulty: int = MIN_DIFFICULTY):
         self.owner = owner
-        # List of transactions with the owner as the destination
-        self.tx_received = []
+        # The key the wallet signs its transactions with, it is kept in a file (wallet_keys/<owner>.key by default) so a restarted wallet can still spend
+        self.private_key = self.load_private_key(key_file or os.path.join("wallet_keys", f"{owner}.key"))
+        # The wallet's address on the chain comes from its key (owner is just the name it goes by here),
+        # miners only take transactions from an address that are signed with its key, and payments to the wallet go to it
+        self.address = signing.address(signing.public_key(self.private_key))
+        # The unspent transactions with the wallet's address as the destination
+        self.utxos = utxo.UTXOSet()
 
         # This is for that loop of a wallet
         self.running = False # Variable to control whether the wallet/loop is active
@@ -17,35 +37,57 @@ class Wallet:
         # My socket to the miner kept closing, so if I add this the miner connection stayed up
         self.miner_socket = None
         self.connected_miner = None
+        # The one buffered reader for miner_socket (a second reader would lose whatever the first had buffered)
+        self._miner_reader = None
         
         # Track which blocks we've already processed
         self.last_processed_block_index = -1
 
+        # A light client (SPV-style) only downloads its own transactions with merkle proofs, instead of every block
+        self.light_client = light_client
+        # The light client's copy of the chain's headers, checked as they come in so the merkle proofs can be checked against them
+        self.headers = headerchain.HeaderChain(min_difficulty)
+
+    def load_private_key(self, path):
+        """
+        Read the wallet's private key from path, or make a new one and save it there the first time
+        The file is only readable by its owner (0600), and one that isn't a whole key raises ValueError
+        """
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                private_key = f.read()
+            if len(private_key) != signing.PRIVATE_KEY_SIZE:
+                raise ValueError(f"{path} is not a wallet key ({len(private_key)} bytes, it should be {signing.PRIVATE_KEY_SIZE})")
+            return private_key
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        private_key = signing.generate_private_key()
+        # O_EXCL so an existing file is never written over (or a file made in between by someone else used)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(private_key)
+        return private_key
+
     def add_transaction(self, transaction: transaction.Transaction):
         """Function that adds transactions where owner is receiver"""
-        if transaction.receiver == self.owner:
-            # Check for duplicates
-            if not any(tx.transaction_id == transaction.transaction_id for tx in self.tx_received):
-                self.tx_received.append(transaction)
+        if transaction.receiver == self.address:
+            # The UTXO set skips duplicates (and coins we have already spent)
+            if self.utxos.add(transaction):
                 print(f"\n[Wallet {self.owner}] UTXO received {transaction.amount} coins from {transaction.sender}!")
 
     def wallet_balance(self):
-        """Function to get the total of the received amount"""
-        balance = 0
-        for tx in self.tx_received:
-            balance += float(tx.amount)
-        return balance
+        """Function to get the total of the received amount (a running total kept by the UTXO set)"""
+        return self.utxos.balance
     
     def see_all_transactions(self):
         """
         Show all transactions where the owner is the receiver
         """
-        if not self.tx_received:
+        if not self.utxos:
             print(f"\n[Wallet {self.owner}] You have no received transactions!!!")
         else:
-            print(f"\n[Wallet {self.owner}] Number of unspent tx: {len(self.tx_received)}")
+            print(f"\n[Wallet {self.owner}] Number of unspent tx: {len(self.utxos)}")
             print(f"[Wallet {self.owner}] List of UTXOs:")
-            for tx in self.tx_received:
+            for tx in self.utxos:
                 print(f"\tID: {tx.transaction_id}, Sender: {tx.sender}, Amount: {tx.amount}")
             print(f"Total balance of transactions: {self.wallet_balance()}")
 
@@ -58,30 +100,20 @@ class Wallet:
         cost = amount + fee
 
         # I am asked to select transactions that cover the cost of the transaction (the wallet does this automatically)
-        cost_covering_tx = []
-        funds = 0
-
-        # Getting self.tx_received, however I cannot do this without it being sorted largest to smalled amount
-        available_tx = sorted(self.tx_received, key=lambda x: float(x.amount), reverse=True)
-        
-        # Starting from the biggest, and moving sequentially until the smallest
+        # Starting from the biggest, and moving sequentially until the smallest (the UTXO set keeps them in order of amount)
         # Select pre-existing tx until we cover the cost of the transaction we want to send
-        for tx in available_tx:
-            if funds >= cost:
-                break
-            cost_covering_tx.append(tx)
-            funds += float(tx.amount)
+        cost_covering_tx = self.utxos.select(cost)
 
         # Error handle if it doesnt have enough funds
-        if funds < cost:
+        if cost_covering_tx is None:
             print(f"[Wallet {self.owner}] ERROR - Insufficient funds!!!")
             print(f"\tRequired: {cost}")
             print(f"\tAvailable: {self.wallet_balance()}")
             return None
         
         # Now I have to remove these transactions from the wallet
-        for tx in cost_covering_tx:
-            self.tx_received.remove(tx)
+        self.utxos.spend(cost_covering_tx)
+        funds = sum(float(tx.amount) for tx in cost_covering_tx)
 
         print(f"[Wallet {self.owner}] {len(cost_covering_tx)} transaction(s) selected, adding up to {funds}")
 
@@ -95,9 +127,10 @@ class Wallet:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as wallet_socket:
                 wallet_socket.connect((bootstrap_host, bootstrap_port))
                 formatter.send_line(wallet_socket, "LIST")
+                reader = formatter.SocketReader(wallet_socket)
                 miners = []
                 while True:
-                    line = formatter.receive_line(wallet_socket)
+                    line = reader.receive_line()
                     if not line:
                         break
                     if line == "END":
@@ -150,6 +183,7 @@ class Wallet:
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 sock.connect((host, port))
                 self.miner_socket = sock
+                self._miner_reader = formatter.SocketReader(sock)
                 self.connected_miner = {"miner": miner, "host": host, "port": port}
                 print(f"[Wallet {self.owner}] Successfully reconnected to {miner} @ {host}:{port}")
                 return True
@@ -165,6 +199,107 @@ class Wallet:
         self.connected_miner = None
         return False
 
+    def fetch_blocks(self, query_socket, reader):
+        """
+        Download every new block and pick out the transactions paying this wallet
+        The blocks come up to BLOCKS_BATCH a request (the miner may send fewer), so keep asking until it has none left for us
+        """
+        while True:
+            formatter.send_line(query_socket, f"GET_BLOCKS {self.last_processed_block_index + 1} {BLOCKS_BATCH}")
+
+            # Each reply is one frame of encoded blocks, from the block we asked for onwards
+            frame = reader.receive_frame()
+            if frame is None:
+                raise ConnectionError("miner closed the connection")
+            new_blocks = block.Block.list_from_bytes(frame)
+
+            for block_index, blk in enumerate(new_blocks, start=self.last_processed_block_index + 1):
+                # If a transaction is for this wallet then add it
+                for tx in blk.data:
+                    if tx.receiver == self.address:
+                        self.add_transaction(tx)
+
+                self.last_processed_block_index = block_index
+
+            if not new_blocks:
+                return
+
+    def sync_headers(self, query_socket, reader):
+        """
+        Light client mode - bring the header chain up to the miner's tip, HEADERS_BATCH fixed-size headers a request
+        Each request starts at our last header, so if the miner's chain no longer has it (a reorg, or a new miner) we step back,
+        further each time, until the chains agree again and fetch on from there
+        """
+        step_back = 1
+        while True:
+            start = max(len(self.headers) - 1, 0)
+            formatter.send_line(query_socket, f"GET_HEADERS {start} {HEADERS_BATCH}")
+            frame = reader.receive_frame()
+            if frame is None:
+                raise ConnectionError("miner closed the connection")
+
+            try:
+                if not frame and start < len(self.headers):
+                    raise headerchain.ChainForked(start)
+                added = self.headers.add_headers(start, frame)
+            except headerchain.ChainForked as e:
+                self.headers.truncate(e.height - step_back)
+                step_back *= 2
+                # The blocks after the fork have to be looked through again
+                self.last_processed_block_index = min(self.last_processed_block_index, len(self.headers) - 1)
+                print(f"[Wallet {self.owner}] Miner's chain forked from ours at block {e.height}, going back to block {len(self.headers)}")
+                continue
+
+            if added:
+                print(f"[Wallet {self.owner}] Synced {added} header(s), chain length is {len(self.headers)}")
+            if len(frame) < HEADERS_BATCH * encoding.HEADER_SIZE:
+                return
+
+    def fetch_owner_transactions(self, query_socket, reader):
+        """
+        Light client mode - only download the transactions paying this wallet, each with a merkle inclusion proof
+        A transaction is only added if its block is in our header chain and the proof hashes up to that header's merkle root
+        """
+        # The miner only looks through so many blocks a request, so keep asking until we are up to our header chain's tip
+        while self.last_processed_block_index + 1 < len(self.headers):
+            start = self.last_processed_block_index + 1
+            formatter.send_line(query_socket, f"GET_TXS {self.address} {start}")
+
+            frame = reader.receive_frame()
+            if frame is None:
+                raise ConnectionError("miner closed the connection")
+
+            view = memoryview(frame)
+            try:
+                version, offset = encoding.read_version(view, 0)
+                scanned_to, offset = encoding.read_varint(view, offset)
+                block_count, offset = encoding.read_varint(view, offset)
+                for _ in range(block_count):
+                    (timestamp, previous_hash, merkle_root, nonce, difficulty), offset = block.Block.read_header(view, offset)
+                    height, offset = encoding.read_varint(view, offset)
+                    tx_count, offset = encoding.read_varint(view, offset)
+
+                    # The header has to be the one in our (already checked) header chain, otherwise the miner could just make up a merkle root
+                    # A block mined since we synced the headers is left for the next query
+                    if height >= len(self.headers):
+                        break
+                    block_hash = block.Block.header_hash(timestamp, merkle_root, previous_hash, nonce, difficulty)
+                    valid_header = block_hash == self.headers.block_hash(height)
+
+                    for _ in range(tx_count):
+                        tx, offset = transaction.Transaction.read(view, offset, version)
+                        index, path, offset = merkle.read_proof(view, offset)
+                        if valid_header and tx.receiver == self.address and merkle.verify(tx.txid, index, path, bytes.fromhex(merkle_root)):
+                            self.add_transaction(tx)
+                        else:
+                            print(f"[Wallet {self.owner}] Rejected transaction {tx.transaction_id} from block {height}: it could not be verified")
+            except encoding.DECODE_ERRORS as e:
+                raise ValueError(f"bad reply from miner: {e}")
+
+            self.last_processed_block_index = min(scanned_to, len(self.headers)) - 1
+            if self.last_processed_block_index < start:
+                return
+
     def query_blockchain_updates(self):
         """
         Queries the miner for blockchain updates using a temp connection, thats refreshed
@@ -184,39 +319,12 @@ class Wallet:
                     query_socket.connect((self.connected_miner['host'], self.connected_miner['port']))
                 
                     # Send blockchain query
-                    formatter.send_line(query_socket, f"GET_BLOCKS {self.last_processed_block_index + 1}")
-                
-                    # Read blocks until END_BLOCKS
-                    while True:
-                        line = formatter.receive_line(query_socket)
-                        if not line or line == "END_BLOCKS":
-                            break
-                    
-                        # Now I have to parse the incoming message
-                        if line.startswith("BLOCK"):
-                            parts = line.split()
-                            if len(parts) >= 3:
-                                block_index = int(parts[1])
-                                num_txs = int(parts[2])
-                                
-                                # Read each transaction in this block
-                                for _ in range(num_txs):
-                                    tx_line = formatter.receive_line(query_socket)
-                                    if tx_line.startswith("TX:"):
-                                        tx_data = tx_line[3:].strip().split(",")
-                                        if len(tx_data) >= 5:
-                                            sender = tx_data[0].strip()
-                                            receiver = tx_data[1].strip()
-                                            amount = float(tx_data[2].strip())
-                                            fee = float(tx_data[3].strip())
-                                            tx_id = tx_data[4].strip()
-                                            
-                                            # If this transaction is for this wallet then add it
-                                            if receiver == self.owner:
-                                                tx = transaction.Transaction(sender, receiver, amount, fee)
-                                                self.add_transaction(tx)
-                                
-                                self.last_processed_block_index = block_index
+                    reader = formatter.SocketReader(query_socket)
+                    if self.light_client:
+                        self.sync_headers(query_socket, reader)
+                        self.fetch_owner_transactions(query_socket, reader)
+                    else:
+                        self.fetch_blocks(query_socket, reader)
 
                     # If we connect again then break this retry loop  
                     break
@@ -244,8 +352,17 @@ class Wallet:
             self.query_blockchain_updates()
             time.sleep(10)
 
+    def miner_reader(self):
+        """The reader for the miner connection, reused for every reply on it (a new one is only made for a new connection)"""
+        if self._miner_reader is None or self._miner_reader.sock is not self.miner_socket:
+            self._miner_reader = formatter.SocketReader(self.miner_socket)
+        return self._miner_reader
+
     def send_transaction_with_retry(self, transaction_message, max_retries=3):
-        """Send the transaction where it retries and reconnects on failure"""
+        """
+        Send the transaction where it retries and reconnects on failure
+        Returns False if it couldn't be sent or the miner answered REJECTED (e.g. a bad signature or too low a fee)
+        """
         retry_count = 0
         
         while retry_count < max_retries:
@@ -257,6 +374,12 @@ class Wallet:
             try:
                 # Attempt to send transaction
                 formatter.send_line(self.miner_socket, transaction_message)
+                reply = self.miner_reader().receive_line()
+                if not reply:
+                    raise ConnectionError("miner closed the connection")
+                if reply != "OK":
+                    print(f"\n[Wallet {self.owner}] Miner {self.connected_miner['miner']} rejected the transaction")
+                    return False
                 print(f"\n[Wallet {self.owner}] Sent transaction to miner {self.connected_miner['miner']}")
                 return True
                 
@@ -276,6 +399,87 @@ class Wallet:
         print(f"[Wallet {self.owner}] Failed to send transaction after {max_retries} attempts")
         return False
 
+    def send_transaction_batch(self, transactions, max_retries=3):
+        """
+        Send many transactions in one go - a SUBMIT line and one frame with all of them, then the miner's RESULTS reply
+        Returns a result for each transaction (mempool.ACCEPTED, DUPLICATE or REJECTED), or None if the batch couldn't be sent
+        Sending the same batch again after a failure is safe, the ones the miner already has just come back as duplicates
+        """
+        retry_count = 0
+
+        while retry_count < max_retries:
+            if not self.miner_socket or not self.connected_miner:
+                print(f"[Wallet {self.owner}] Not connected to a miner, attempting to reconnect...")
+                if not self.reconnect_to_miner():
+                    return None
+
+            try:
+                formatter.send_line(self.miner_socket, f"SUBMIT {len(transactions)}")
+                formatter.send_frame(self.miner_socket, transaction.Transaction.list_to_bytes(transactions))
+
+                # Skip over any other lines until the reply (e.g. from a miner that answered something sent before)
+                reader = self.miner_reader()
+                while True:
+                    line = reader.receive_line()
+                    if not line:
+                        raise ConnectionError("miner closed the connection")
+                    if line.startswith("RESULTS"):
+                        break
+                results = reader.receive_frame()
+                if results is None or len(results) != len(transactions):
+                    raise ConnectionError("bad RESULTS reply from miner")
+
+                print(f"\n[Wallet {self.owner}] Sent {len(transactions)} transaction(s) to miner {self.connected_miner['miner']}")
+                return list(results)
+
+            except Exception as e:
+                retry_count += 1
+                print(f"[Wallet {self.owner}] Error sending the batch ({retry_count}/{max_retries}): {e}")
+
+                print(f"[Wallet {self.owner}] Miner connection lost, attempting to reconnect...")
+                if not self.reconnect_to_miner():
+                    print(f"[Wallet {self.owner}] Could not reconnect to any miner")
+                    return None
+
+        print(f"[Wallet {self.owner}] Failed to send the batch after {max_retries} attempts")
+        return None
+
+    def send_payouts(self, payments):
+        """
+        Pay many receivers at once (e.g. a payment processor's payouts), payments is a list of (receiver, amount, fee)
+        The UTXOs are selected once for the total, the transactions go to the miner as a single batch,
+        and anything the miner rejects is refunded back into the wallet the same way change is
+        Returns the miner's result for each payment, or None if nothing was sent
+        """
+        cost = sum(float(amount) + float(fee) for _, amount, fee in payments)
+        selected_transactions = self.select_sufficient_transactions(cost, 0)
+        if selected_transactions is None:
+            return None
+
+        new_transactions = [transaction.Transaction(self.address, receiver, amount, fee) for receiver, amount, fee in payments]
+        for tx in new_transactions:
+            tx.sign(self.private_key)
+        change = sum(float(tx.amount) for tx in selected_transactions) - cost
+        change_tx = None
+        if change > 0:
+            change_tx = transaction.Transaction(self.address, self.address, change, 0)
+            self.add_transaction(change_tx)
+
+        results = self.send_transaction_batch(new_transactions)
+        if results is None:
+            # Nothing went through, so just revert UTXOs
+            print(f"[Wallet {self.owner}] Payouts failed - reverting UTXOs")
+            self.utxos.unspend(selected_transactions)
+            if change_tx is not None:
+                self.utxos.remove(change_tx.txid)
+            return None
+
+        refund = sum(float(tx.amount) + tx.fee for tx, result in zip(new_transactions, results) if result == mempool.REJECTED)
+        if refund > 0:
+            self.add_transaction(transaction.Transaction(self.address, self.address, refund, 0))
+            print(f"[Wallet {self.owner}] {results.count(mempool.REJECTED)} payout(s) rejected, {refund} coins refunded")
+        return results
+
     def wallet_loop(self):
         """
         I need a running loop for each wallet
@@ -298,7 +502,7 @@ class Wallet:
             if reply == "yes":
                 # collate information on transaction - receivee, amount and fee
                 try:
-                    input_receiver = str(input(f"\n[Wallet {self.owner}] Who are you going to send it to?\n")).strip()
+                    input_receiver = str(input(f"\n[Wallet {self.owner}] Who are you going to send it to (their address)?\n")).strip()
                     input_amount = float(input(f"\n[Wallet {self.owner}] What amount are you going to send?\n").strip())
                     input_fee = float(input(f"\n[Wallet {self.owner}] What fee amount are you willing to spend?\n").strip())
 
@@ -319,7 +523,8 @@ class Wallet:
                 # If there is selected UTXOs amounting to the min_trans number
                 if selected_transactions != None:
                     # Make the new transaction
-                    new_transaction = transaction.Transaction(self.owner, input_receiver, input_amount, input_fee)
+                    new_transaction = transaction.Transaction(self.address, input_receiver, input_amount, input_fee)
+                    new_transaction.sign(self.private_key)
                     # Print the information about the creation of the transaction
                     print(f"\n[Wallet {self.owner}] Transaction {new_transaction.transaction_id} created!!!")
                     print(f"\tSender: {new_transaction.sender}")
@@ -334,20 +539,19 @@ class Wallet:
                     # Everytime I made a Transaction I never got change back from the used UTXOs
                     if change > 0:
                         # Make a UTXO for the balanced money to go back to me
-                        change_tx = transaction.Transaction(self.owner, self.owner, change, 0)
+                        change_tx = transaction.Transaction(self.address, self.address, change, 0)
                         self.add_transaction(change_tx)
                         print(f"\n[Wallet {self.owner}] Change of {change} coins returned back")
 
-                    transaction_message = f"Transaction: {new_transaction.sender}, {new_transaction.receiver}, {new_transaction.amount}, {new_transaction.fee}, {new_transaction.transaction_id}"
+                    transaction_message = f"Transaction: {new_transaction.sender}, {new_transaction.receiver}, {new_transaction.amount}, {new_transaction.fee}, {new_transaction.transaction_id}, {new_transaction.timestamp}, {new_transaction.public_key.hex()}, {new_transaction.signature.hex()}"
 
                     if not self.send_transaction_with_retry(transaction_message):
                         # Transaction failed after all my retry attempts, so just revert UTXOs
                         print(f"[Wallet {self.owner}] Transaction failed - reverting UTXOs")
-                        for tx in selected_transactions:
-                            self.tx_received.append(tx)
+                        self.utxos.unspend(selected_transactions)
                         if change > 0:
                             # Undo the change transaction we added
-                            self.tx_received = [tx for tx in self.tx_received if tx.transaction_id != change_tx.transaction_id]
+                            self.utxos.remove(change_tx.txid)
 
             # Terminate the wallet
             elif reply == "exit":
@@ -380,9 +584,10 @@ class Wallet:
 
             # Request details of miners in the network
             formatter.send_line(wallet_socket, "LIST")
+            reader = formatter.SocketReader(wallet_socket)
             miners = []
             while True:
-                line = formatter.receive_line(wallet_socket)
+                line = reader.receive_line()
                 if not line:
                     print(f"\n[Wallet {self.owner}] Bootstrap node closed")
                     return
@@ -416,6 +621,7 @@ class Wallet:
         try:
             self.miner_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.miner_socket.connect((host, port))
+            self._miner_reader = formatter.SocketReader(self.miner_socket)
             self.connected_miner = {"miner": miner, "host": host, "port": port}
 
             print(f"[Wallet {self.owner}] Connected to {miner} @ {host}:{port}")
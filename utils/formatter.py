@@ -1,3 +1,5 @@
+import struct
+
 def data_helper(sender: str, receiver: str, amount: str, time: float):
     """
     Helper function to produce data to be added to blocks.
@@ -17,16 +19,117 @@ def send_line(sock, s):
     except Exception:
         pass
 
-def receive_line(sock):
-    """Function is to understand/receive a line over a socket"""
-    data = bytearray()
+# Bulk payloads (like a batch of blocks) are sent as a frame, a 4 byte big-endian length and then the payload itself
+FRAME_HEADER = struct.Struct(">I")
+
+def send_frame(sock, payload: bytes | str):
+    """Function to send a length-prefixed frame over a socket, in one sendall"""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    try:
+        sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+    except Exception:
+        pass
+
+class SocketReader:
+    """
+    Buffered reader for one connection, it reads the socket in big chunks and hands back a line (or a frame) at a time
+    Receiving a byte at a time meant a syscall for every single byte
+    There should only ever be one of these per socket, anything it has buffered is lost if something else reads the socket
+    """
+    def __init__(self, sock, chunk_size: int = 65536):
+        self.sock = sock
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._pos = 0 # how far into the buffer we have already handed back
+
+    def _fill(self):
+        """Read the next chunk from the socket into the buffer, returns False if the connection closed"""
+        # Throw away what has already been read so the buffer doesn't keep growing
+        if self._pos:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        chunk = self.sock.recv(self.chunk_size)
+        if not chunk:
+            return False
+        self._buffer += chunk
+        return True
+
+    def receive_line(self):
+        """Function is to understand/receive a line over a socket, it returns "" if the connection closed or failed"""
+        try:
+            scanned = 0 # bytes after self._pos already known to have no newline
+            while True:
+                end = self._buffer.find(b"\n", self._pos + scanned)
+                if end >= 0:
+                    line = self._buffer[self._pos:end].decode("utf-8", errors="replace")
+                    self._pos = end + 1
+                    return line
+                scanned = len(self._buffer) - self._pos
+                if not self._fill():
+                    return ""
+        except Exception:
+            return ""
+
+    def receive_exactly(self, n: int):
+        """Receive exactly n bytes, returns None if the connection closed or failed before they all arrived"""
+        try:
+            while len(self._buffer) - self._pos < n:
+                if not self._fill():
+                    return None
+            data = bytes(self._buffer[self._pos:self._pos + n])
+            self._pos += n
+            return data
+        except Exception:
+            return None
+
+    def receive_frame(self):
+        """Receive one frame from send_frame(), returns None if the connection closed or failed"""
+        header = self.receive_exactly(FRAME_HEADER.size)
+        if header is None:
+            return None
+        return self.receive_exactly(FRAME_HEADER.unpack(header)[0])
+
+# The miner's networking runs on asyncio, so these are the same helpers for an asyncio StreamReader/StreamWriter
+# Lines can be long (a block with all of its transactions), so connections are opened with a bigger line limit
+STREAM_LIMIT = 1 << 24
+
+def line_bytes(s):
+    """A line as the bytes that go on the wire"""
+    return (s.rstrip("\n") + "\n").encode("utf-8")
+
+def frame_bytes(payload: bytes | str):
+    """A length-prefixed frame as the bytes that go on the wire"""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def write_line(writer, s):
+    """Queue a line on an asyncio StreamWriter, it never blocks (the event loop sends it when it can)"""
+    if writer.is_closing():
+        return
+    writer.write(line_bytes(s))
+
+def write_frame(writer, payload: bytes | str):
+    """Queue a length-prefixed frame on an asyncio StreamWriter"""
+    if writer.is_closing():
+        return
+    writer.write(frame_bytes(payload))
+
+async def read_line(reader):
+    """Read a line from an asyncio StreamReader, it returns "" if the connection closed or failed"""
+    try:
+        data = await reader.readline()
+    except Exception:
+        return ""
+    if not data.endswith(b"\n"):
+        return ""
+    return data[:-1].decode("utf-8", errors="replace")
+
+async def read_frame(reader):
+    """Read one frame from an asyncio StreamReader, returns None if the connection closed or failed"""
     try:
-        while True:
-            ch = sock.recv(1)
-            if not ch:
-                return ""
-            data += ch
-            if ch == b"\n":
-                return data.decode("utf-8", errors="replace").rstrip("\n")
+        header = await reader.readexactly(FRAME_HEADER.size)
+        return await reader.readexactly(FRAME_HEADER.unpack(header)[0])
     except Exception:
-        return ""
\ No newline at end of file
+        return None